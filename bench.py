@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+"""Offline throughput benchmark of the collectors
+
+Replays recorded or synthetic /debug/vars payloads, scaled to a number of
+tagged keys, through the vttablet and vtgate collectors with a collectd
+stand-in that discards every value, and reports values per second, the time
+spent in each phase of a read and the peak memory for every payload size.
+
+    python bench.py --sizes 1000,10000,100000
+    python bench.py --collector vttablet --payload vttablet=recorded_vttablet.json --json
+
+Each case runs in a fresh python process, so peak memory is that of a single
+collector reading a single payload size.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock
+
+mock.install_null_collectd('bench')
+
+import util
+import vtgate_collectd
+import vttablet_collectd
+
+COLLECTORS = {
+    'vttablet': vttablet_collectd.Vttablet,
+    'vtgate': vtgate_collectd.Vtgate,
+}
+DEFAULT_SIZES = [1000, 10000, 100000]
+# Untagged values that aren't numbers
+SAMPLE_VALUES = {'TabletType': 'MASTER'}
+# Buckets of a timing histogram, in ns
+TIMING_BUCKETS = ['500000', '1000000', '5000000', '10000000', '50000000', '100000000', '500000000', '1000000000']
+RESULTS_BUCKETS = ['0', '1', '5', '10', '50', '100', '500', '1000', '5000', '10000']
+
+def tag_key(tags, i):
+    # The first tag is unique per key, the others cycle through a few values
+    return '.'.join(["%s%d" % (tag.lower(), i if n == 0 else i % (n + 3)) for n, tag in enumerate(tags)])
+
+def histogram(buckets, i):
+    counts = [i * (n + 1) for n in range(len(buckets))]
+    h = dict(zip(buckets, counts))
+    h['inf'] = h['Count'] = counts[-1] + i
+    return h
+
+def synthesize(collector_cls, keys):
+    """Builds a payload with every metric of collector_cls, spreading keys tagged keys across its tagged metrics"""
+    metrics = collector_cls.metrics
+    scalable = [entry for entry in metrics if entry.get('tags') or entry.get('kind') in ('timing', 'custom')]
+    per_metric = max(1, keys // max(1, len(scalable)))
+    payload = {}
+    for entry in metrics:
+        name = entry['name']
+        kind = entry.get('kind', 'metric')
+        tags = entry.get('tags')
+        if kind == 'metric' and not tags:
+            section = payload.setdefault(entry['source'], {}) if entry.get('source') else payload
+            section[name] = SAMPLE_VALUES.get(name, 12345)
+        elif kind == 'metric':
+            payload[name] = dict((tag_key(tags, i), i) for i in range(per_metric))
+        elif kind == 'timing':
+            histograms = {}
+            for i in range(per_metric):
+                key = tag_key(tags, i) if tags else "Key%d" % i
+                histograms[key] = histogram(TIMING_BUCKETS, i)
+                histograms[key]['Time'] = i * 1000000
+            payload[name] = {'TotalCount': per_metric, 'TotalTime': per_metric * 1000000, 'Histograms': histograms}
+        elif kind == 'histogram':
+            payload[name] = histogram(RESULTS_BUCKETS, 1)
+            payload[name]['Total'] = 100
+        elif entry['method'] == 'process_rates':
+            payload[name] = dict(("%s%d" % (entry['args'][0], i), [float(i)] * 15) for i in range(per_metric))
+            payload[name]['All'] = [float(per_metric)] * 15
+    return payload
+
+def scale(payload, keys):
+    """Grows the tagged sections of a recorded payload to about keys tagged keys in total"""
+    tagged = [name for name, value in payload.items()
+              if isinstance(value, dict) and value and all(isinstance(v, (int, long, float)) for v in value.values())
+              and all('.' in k for k in value)]
+    timings = [name for name, value in payload.items() if isinstance(value, dict) and isinstance(value.get('Histograms'), dict)]
+    per_section = max(1, keys // max(1, len(tagged) + len(timings)))
+    scaled = dict(payload)
+    for name in tagged:
+        scaled[name] = _replicate(payload[name], per_section)
+    for name in timings:
+        scaled[name] = dict(payload[name])
+        scaled[name]['Histograms'] = _replicate(payload[name]['Histograms'], per_section)
+    return scaled
+
+def _replicate(section, count):
+    # New keys differ in their first component, so they parse into the same tags
+    originals = sorted(section.items())
+    result = {}
+    for i in range(count):
+        key, value = originals[i % len(originals)]
+        first, sep, rest = key.partition('.')
+        result["%s%d%s%s" % (first, i // len(originals), sep, rest) if i >= len(originals) else key] = value
+    return result
+
+def run_case(collector_name, path, repeat, options):
+    """Reads the payload at path repeat times after a warm up read, returns the averaged measurements"""
+    collector = COLLECTORS[collector_name](mock.CollectdNullMock(collector_name))
+    for option, value in options.items():
+        setattr(collector, option, value)
+    provider = util.FileJsonProvider(path)
+    collector.include_self_metrics = False
+    collector.targets = [collector.create_target(provider)]
+    collector.prepare()
+    target = collector.targets[0]
+
+    totals = {'parse': 0.0, 'process': 0.0, 'dispatch': 0.0, 'values': 0}
+    for i in range(repeat + 1):
+        json_data = provider.get_json()
+        collector.process_target(target, json_data)
+        start = time.time()
+        target.emitter.flush()
+        dispatch_time = time.time() - start
+        if i == 0:
+            continue
+        totals['parse'] += provider.parse_time
+        totals['process'] += target.stats.process_time
+        totals['dispatch'] += dispatch_time
+        totals['values'] += target.stats.values_emitted
+
+    busy = totals['process'] + totals['dispatch']
+    return {
+        'collector': collector_name,
+        'payload_bytes': os.path.getsize(path),
+        'values': totals['values'] // repeat,
+        'parse_ms': totals['parse'] / repeat * 1000,
+        'process_ms': totals['process'] / repeat * 1000,
+        'dispatch_ms': totals['dispatch'] / repeat * 1000,
+        'values_per_sec': totals['values'] / busy if busy else 0.0,
+        # ru_maxrss is in KB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vitess collectors against replayed payloads")
+    parser.add_argument('--collector', action='append', choices=sorted(COLLECTORS),
+                        help='Collector to benchmark, may be repeated (default: all)')
+    parser.add_argument('--payload', action='append', default=[],
+                        help='Recorded /debug/vars of a collector, as collector=path, or just a path with a single '
+                             '--collector (default: synthetic)')
+    parser.add_argument('--sizes', action='store', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated numbers of tagged keys to scale payloads to')
+    parser.add_argument('--repeat', action='store', type=int, default=5,
+                        help='Reads measured per case, after one warm up read')
+    parser.add_argument('--streaming-parse', action='store_true',
+                        help='Only parse the keys the collector uses')
+    parser.add_argument('--batch-dispatch', action='store_true',
+                        help='Dispatch all values at the end of each read')
+    parser.add_argument('--reuse-unchanged', action='store_true',
+                        help='Reuse the results of sections that did not change since the last read')
+    parser.add_argument('--json', action='store_true',
+                        help='Print one json object per case instead of a table')
+    parser.add_argument('--run-case', nargs=2, metavar=('COLLECTOR', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    options = {
+        'streaming_parse': args.streaming_parse,
+        'batch_dispatch': args.batch_dispatch,
+        'reuse_unchanged': args.reuse_unchanged,
+    }
+    if args.run_case:
+        print json.dumps(run_case(args.run_case[0], args.run_case[1], args.repeat, options))
+        return
+
+    recorded = {}
+    for payload in args.payload:
+        collector_name, sep, path = payload.partition('=')
+        if not sep or collector_name not in COLLECTORS:
+            if not args.collector or len(args.collector) != 1:
+                parser.error("--payload %s: give it as collector=path, or benchmark a single --collector" % payload)
+            collector_name, path = args.collector[0], payload
+        recorded[collector_name] = path
+    flags = [flag for flag, option in (('--streaming-parse', 'streaming_parse'), ('--batch-dispatch', 'batch_dispatch'),
+                                       ('--reuse-unchanged', 'reuse_unchanged')) if options[option]]
+    if not args.json:
+        print "%-9s %8s %10s %8s %9s %11s %12s %12s %9s" % (
+            'collector', 'keys', 'bytes', 'values', 'parse_ms', 'process_ms', 'dispatch_ms', 'values/sec', 'peak_mb')
+    for collector_name in args.collector or sorted(COLLECTORS):
+        base = None
+        if collector_name in recorded:
+            with open(recorded[collector_name]) as f:
+                base = json.load(f)
+        for size in [int(size) for size in args.sizes.split(',')]:
+            payload = scale(base, size) if base is not None else synthesize(COLLECTORS[collector_name], size)
+            fd, path = tempfile.mkstemp(prefix='vitess-bench-', suffix='.json')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(payload, f)
+                del payload
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-case', collector_name, path,
+                                                  '--repeat', str(args.repeat)] + flags)
+            finally:
+                os.remove(path)
+            result = json.loads(output)
+            result['keys'] = size
+            if args.json:
+                print json.dumps(result, sort_keys=True)
+            else:
+                print "%-9s %8d %10d %8d %9.1f %11.1f %12.1f %12.0f %9.1f" % (
+                    collector_name, size, result['payload_bytes'], result['values'], result['parse_ms'],
+                    result['process_ms'], result['dispatch_ms'], result['values_per_sec'], result['peak_rss_mb'])
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/python
+
+"""Load testing inputs for the collectors
+
+    record    snapshots live /debug/vars responses into a corpus directory
+    generate  writes synthetic payloads with controllable cardinality into a corpus directory
+    serve     serves a corpus at many ports at once, like a fleet of vitess binaries
+
+A corpus is a directory of gzip compressed /debug/vars payloads (*.json.gz).
+
+    python fleet.py record --url http://tablet-1:15101/debug/vars --count 3 --out corpus/
+    python fleet.py generate --collector vttablet --tablets 20 --tables 200 --users 50 --out corpus/
+    python fleet.py serve --corpus corpus/ --ports 16000-16499
+
+The server hands out the corpus' payloads round robin across its ports, and
+also answers vtctld's /api/tablets/ on the first port so discovery can be
+pointed at it.
+"""
+
+import argparse
+import BaseHTTPServer
+import SocketServer
+import glob
+import gzip
+import hashlib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import urllib2
+import urlparse
+from cStringIO import StringIO
+
+import mock
+
+mock.install_null_collectd('fleet')
+
+import util
+import vtgate_collectd
+import vttablet_collectd
+
+COLLECTORS = {
+    'vttablet': vttablet_collectd.Vttablet,
+    'vtgate': vtgate_collectd.Vtgate,
+}
+# Upper bounds (ns) of vitess' default timing histogram buckets
+TIMING_BUCKETS = [500000, 1000000, 5000000, 10000000, 50000000, 100000000, 500000000, 1000000000, 5000000000, 10000000000]
+RESULTS_BUCKETS = [0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000]
+# Keys of untagged timings, by timing name
+TIMING_KEYS = {
+    'Mysql': ['Exec', 'ExecStream'],
+    'MysqlAllPrivs': ['Exec', 'ExecStream'],
+    'MysqlApp': ['Exec', 'ExecStream'],
+    'MysqlDba': ['Exec', 'ExecStream'],
+    'Queries': ['PASS_SELECT', 'SELECT_PK', 'INSERT_PK', 'UPDATE_PK', 'DELETE_PK', 'DDL'],
+    'Transactions': ['Completed', 'Aborted'],
+    'Waits': ['Consolidations'],
+    'ExternalReparents': ['PlannedReparentShard'],
+}
+# Fixed values of tags whose cardinality isn't configurable
+TAG_VALUES = {
+    'type': ['Select', 'Insert', 'Update', 'Delete'],
+    'plan': ['PASS_SELECT', 'SELECT_PK', 'INSERT_PK', 'UPDATE_PK', 'DDL'],
+    'dbtype': ['master', 'replica', 'rdonly'],
+    'operation': ['Execute', 'StreamExecute', 'ExecuteBatch'],
+    'code': ['UNKNOWN', 'INVALID_ARGUMENT', 'DEADLINE_EXCEEDED'],
+    'reason': ['BufferFull', 'ContextDone'],
+    'log': ['QueryLog', 'TxLog'],
+    'subscriber': ['sub0', 'sub1'],
+}
+SUFFIX = '.json.gz'
+
+class FleetGenerator(object):
+    """Builds synthetic /debug/vars payloads in the shapes the collectors read
+
+    Every metric in a collector's METRICS table gets a value, with one key
+    per combination of its tags' values.  The number of tables, users, ACL
+    ids, keyspaces and shards, and of timing histogram buckets, is
+    configurable, so the cardinality of the payloads can be dialled up.
+
+    Arguments
+        collector_cls -- Vttablet or Vtgate
+        tables, users, acl_ids, keyspaces, shards -- number of values of those tags
+        buckets -- number of timing histogram buckets, before "inf"
+    """
+    def __init__(self, collector_cls, tables=10, users=5, acl_ids=3, keyspaces=2, shards=2, buckets=8):
+        self.collector_cls = collector_cls
+        self.buckets = [str(bound) for bound in (TIMING_BUCKETS + [TIMING_BUCKETS[-1] * 2 ** (i + 1) for i in range(buckets)])[:buckets]]
+        self.tag_values = dict(TAG_VALUES)
+        self.tag_values.update({
+            'table': ["t%d" % i for i in range(tables)],
+            # DDL by users outside the migration group is reported separately; vitess escapes periods in keys
+            'user': ["migration\\.user0"] + ["user%d" % i for i in range(1, users)],
+            'id': ["DDL"] + ["acl%d" % i for i in range(1, acl_ids)],
+            'keyspace': ["ks%d" % i for i in range(keyspaces)],
+            'shard': _shard_names(shards),
+            'shardname': _shard_names(shards),
+        })
+
+    def payload(self, index):
+        """Returns the payload of the index-th binary of the fleet"""
+        rand = random.Random(index)
+        payload = {}
+        for entry in self.collector_cls.metrics:
+            name = entry['name']
+            kind = entry.get('kind', 'metric')
+            tags = entry.get('tags')
+            if kind == 'metric' and not tags:
+                section = payload.setdefault(entry['source'], {}) if entry.get('source') else payload
+                section[name] = ('MASTER' if index == 0 else 'REPLICA') if name == 'TabletType' else rand.randint(0, 100000)
+            elif kind == 'metric':
+                payload[name] = dict((key, rand.randint(0, 100000)) for key in self.keys(tags))
+            elif kind == 'timing':
+                keys = self.keys(tags) if tags else TIMING_KEYS.get(name, ['Total'])
+                histograms = dict((key, self.histogram(self.buckets, rand)) for key in keys)
+                payload[name] = {
+                    'TotalCount': sum(h['Count'] for h in histograms.itervalues()),
+                    'TotalTime': sum(h['Time'] for h in histograms.itervalues()),
+                    'Histograms': histograms,
+                }
+            elif kind == 'histogram':
+                histogram = self.histogram([str(bound) for bound in RESULTS_BUCKETS], rand)
+                histogram['Total'] = histogram.pop('Time')
+                payload[name] = histogram
+            elif entry.get('method') == 'process_rates':
+                values = self.tag_values.get(entry['args'][0].lower(), ["x%d" % i for i in range(3)])
+                payload[name] = dict((value, [rand.uniform(0, 1000) for _ in range(15)]) for value in values + ['All'])
+        return payload
+
+    def keys(self, tags):
+        keys = ['']
+        for tag in tags:
+            values = self.tag_values.get(tag.lower(), ["x%d" % i for i in range(3)])
+            keys = ["%s.%s" % (key, value) if key else value for key in keys for value in values]
+        return keys
+
+    def histogram(self, buckets, rand):
+        # Vitess reports cumulative counts
+        histogram = {}
+        count = 0
+        for bound in buckets:
+            count += rand.randint(0, 1000)
+            histogram[bound] = count
+        count += rand.randint(0, 10)
+        histogram['inf'] = histogram['Count'] = count
+        histogram['Time'] = count * rand.randint(100000, 10000000)
+        return histogram
+
+def _shard_names(shards):
+    if shards <= 1:
+        return ['0']
+    bounds = [''] + ["%02x" % (256 * i // shards) for i in range(1, shards)] + ['']
+    return ["%s-%s" % (bounds[i], bounds[i + 1]) for i in range(shards)]
+
+def write_payload(path, payload):
+    # Compact separators and gzip keep a corpus of large payloads small
+    with gzip.open(path, 'wb') as f:
+        f.write(json.dumps(payload, separators=(',', ':'), sort_keys=True))
+
+def load_corpus(directory):
+    paths = sorted(glob.glob(os.path.join(directory, '*' + SUFFIX)))
+    if not paths:
+        raise ValueError("No %s files in %s" % (SUFFIX, directory))
+    corpus = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            compressed = f.read()
+        corpus.append(CorpusEntry(os.path.basename(path), compressed))
+    return corpus
+
+class CorpusEntry(object):
+    """A payload of the corpus, kept both compressed and decompressed"""
+    def __init__(self, name, compressed):
+        self.name = name
+        self.compressed = compressed
+        self.body = gzip.GzipFile(fileobj=StringIO(compressed)).read()
+        self.etag = '"%s"' % hashlib.md5(self.body).hexdigest()
+        self._filtered = {}
+        self._lock = threading.Lock()
+
+    def filtered(self, keys):
+        """Returns the body with only keys, as for /debug/vars?var=..."""
+        key = tuple(sorted(keys))
+        with self._lock:
+            body = self._filtered.get(key)
+            if body is None:
+                data = json.loads(self.body)
+                body = self._filtered[key] = json.dumps(dict((k, data[k]) for k in key if k in data), separators=(',', ':'))
+        return body
+
+class FleetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        fleet = self.server.fleet
+        if fleet.latency:
+            time.sleep(fleet.latency)
+        if fleet.error_rate and random.random() < fleet.error_rate:
+            return self.respond(500, 'Injected failure\n')
+        parsed = urlparse.urlparse(self.path)
+        if parsed.path.startswith('/api/tablets'):
+            return self.respond(200, json.dumps(fleet.tablets(parsed.path)))
+        if parsed.path != fleet.path:
+            return self.respond(404, 'Not found\n')
+
+        entry = fleet.entry(self.server.server_address[1])
+        if self.headers.get('If-None-Match') == entry.etag:
+            return self.respond(304, '', {'ETag': entry.etag})
+        keys = urlparse.parse_qs(parsed.query).get(fleet.filter_param)
+        if keys:
+            return self.respond(200, entry.filtered(keys))
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            return self.respond(200, entry.compressed, {'ETag': entry.etag, 'Content-Encoding': 'gzip'})
+        return self.respond(200, entry.body, {'ETag': entry.etag})
+
+    def respond(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.fleet.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class FleetServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def process_request_thread(self, request, client_address):
+        with self._lock:
+            self._connections.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._lock:
+                self._connections.discard(request)
+
+    def handle_error(self, request, client_address):
+        # Clients giving up on slow responses are expected with --latency
+        if isinstance(sys.exc_info()[1], socket.error) and not self.fleet.verbose:
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def close_connections(self):
+        """Ends the keep-alive connections still open, so their handler threads exit"""
+        with self._lock:
+            connections = list(self._connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class Fleet(object):
+    """Serves a corpus at many ports at once
+
+    Arguments
+        corpus -- list of CorpusEntry, handed out round robin across ports
+        ports -- list of ports to listen on
+        host -- address to listen on (default 127.0.0.1)
+        path -- path payloads are served at (default /debug/vars)
+        latency -- seconds to wait before answering each request
+        error_rate -- fraction of requests to fail with HTTP 500
+        filter_param -- query parameter selecting keys of a payload (default 'var')
+    """
+    def __init__(self, corpus, ports, host='127.0.0.1', path='/debug/vars', latency=0.0, error_rate=0.0,
+                 filter_param='var', verbose=False):
+        self.corpus = corpus
+        self.ports = [int(port) for port in ports]
+        self.host = host
+        self.path = path
+        self.latency = latency
+        self.error_rate = error_rate
+        self.filter_param = filter_param
+        self.verbose = verbose
+        self._entries = dict((port, corpus[i % len(corpus)]) for i, port in enumerate(self.ports))
+        self._servers = []
+
+    def entry(self, port):
+        return self._entries[port]
+
+    def tablets(self, path):
+        """Answers vtctld's tablet list, and tablet records by alias"""
+        alias = path.rstrip('/').rsplit('/', 1)[-1]
+        if alias.startswith('fleet-'):
+            port = int(alias.split('-', 1)[1])
+            return {'alias': {'cell': 'fleet', 'uid': port}, 'hostname': self.host, 'port_map': {'vt': port}}
+        return [{'cell': 'fleet', 'uid': port} for port in self.ports]
+
+    def start(self):
+        for port in self.ports:
+            server = FleetServer((self.host, port), FleetHandler)
+            server.fleet = self
+            thread = threading.Thread(target=server.serve_forever, name="fleet-%d" % port)
+            thread.daemon = True
+            thread.start()
+            self._servers.append(server)
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.close_connections()
+            server.server_close()
+        self._servers = []
+
+def record(args):
+    urls = list(args.url)
+    urls.extend(["http://%s:%s%s" % (args.host, port, args.path) for port in util.parse_ports(args.port)])
+    if not urls:
+        raise SystemExit("Nothing to record, give --url or --port")
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    for n in range(args.count):
+        if n:
+            time.sleep(args.interval)
+        for url in urls:
+            parsed = urlparse.urlparse(url)
+            response = urllib2.urlopen(url, timeout=args.timeout)
+            try:
+                payload = json.load(response)
+            finally:
+                response.close()
+            path = os.path.join(args.out, "%s_%s-%03d%s" % (parsed.hostname.replace('.', '_'), parsed.port or 80, n, SUFFIX))
+            write_payload(path, payload)
+            print "%s -> %s" % (url, path)
+
+def generate(args):
+    generator = FleetGenerator(COLLECTORS[args.collector], tables=args.tables, users=args.users, acl_ids=args.acl_ids,
+                               keyspaces=args.keyspaces, shards=args.shards, buckets=args.buckets)
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    for index in range(args.tablets):
+        path = os.path.join(args.out, "%s-%03d%s" % (args.collector, index, SUFFIX))
+        write_payload(path, generator.payload(index))
+        print path
+
+def serve(args):
+    fleet = Fleet(load_corpus(args.corpus), util.parse_ports([args.ports]), host=args.host, path=args.path,
+                  latency=args.latency / 1000.0, error_rate=args.error_rate, verbose=args.verbose)
+    fleet.start()
+    print "Serving %d payloads at %d ports on %s, discovery at http://%s:%d/api/tablets/" % (
+        len(fleet.corpus), len(fleet.ports), args.host, args.host, fleet.ports[0])
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fleet.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Record, generate and serve /debug/vars payloads for load testing")
+    commands = parser.add_subparsers()
+
+    parser_record = commands.add_parser('record', help='Snapshot live /debug/vars responses into a corpus')
+    parser_record.add_argument('--url', action='append', default=[], help='Url to record, may be repeated')
+    parser_record.add_argument('--host', action='store', default='localhost', help='Host of --port')
+    parser_record.add_argument('--port', action='append', default=[], help='Port(s) on host to record, i.e. 15101-15140')
+    parser_record.add_argument('--path', action='store', default='/debug/vars', help='Path on host to record')
+    parser_record.add_argument('--count', action='store', type=int, default=1, help='Snapshots to take of each url')
+    parser_record.add_argument('--interval', action='store', type=float, default=10, help='Seconds between snapshots')
+    parser_record.add_argument('--timeout', action='store', type=float, default=util.DEFAULT_DEADLINE, help='Seconds to wait on each url')
+    parser_record.add_argument('--out', action='store', required=True, help='Corpus directory')
+    parser_record.set_defaults(func=record)
+
+    parser_generate = commands.add_parser('generate', help='Write synthetic payloads into a corpus')
+    parser_generate.add_argument('--collector', action='store', choices=sorted(COLLECTORS), default='vttablet')
+    parser_generate.add_argument('--tablets', action='store', type=int, default=1, help='Payloads to generate')
+    parser_generate.add_argument('--tables', action='store', type=int, default=10)
+    parser_generate.add_argument('--users', action='store', type=int, default=5)
+    parser_generate.add_argument('--acl-ids', action='store', type=int, default=3)
+    parser_generate.add_argument('--keyspaces', action='store', type=int, default=2)
+    parser_generate.add_argument('--shards', action='store', type=int, default=2)
+    parser_generate.add_argument('--buckets', action='store', type=int, default=8, help='Timing histogram buckets')
+    parser_generate.add_argument('--out', action='store', required=True, help='Corpus directory')
+    parser_generate.set_defaults(func=generate)
+
+    parser_serve = commands.add_parser('serve', help='Serve a corpus at many ports')
+    parser_serve.add_argument('--corpus', action='store', required=True, help='Corpus directory')
+    parser_serve.add_argument('--ports', action='store', default='16000-16009', help='Ports to serve, i.e. 16000-16499')
+    parser_serve.add_argument('--host', action='store', default='127.0.0.1', help='Address to listen on')
+    parser_serve.add_argument('--path', action='store', default='/debug/vars', help='Path to serve payloads at')
+    parser_serve.add_argument('--latency', action='store', type=float, default=0, help='Milliseconds to delay each response')
+    parser_serve.add_argument('--error-rate', action='store', type=float, default=0, help='Fraction of requests to fail')
+    parser_serve.add_argument('--verbose', '-v', action='store_true', help='Log every request')
+    parser_serve.set_defaults(func=serve)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+import json
+import re
+
+# Bytes read from the underlying file object at a time
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING_SPECIAL = re.compile(r'["\\]')
+# A complete string including its quotes
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+# Everything up to the next bracket, skipping over complete strings. Stops at a
+# quote whose string hasn't been read in full yet.
+_CONTAINER_RUN = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+_SCALAR_END = re.compile(r'[,}\] \t\n\r]')
+
+class SelectiveJsonParser(object):
+    """Streaming parser for a top level JSON object that decodes only some keys
+
+    The object is read from a file-like object in chunks.  Values of the
+    requested keys are decoded with the json module, while every other value
+    is skipped by scanning for its end without building any objects, and its
+    bytes are discarded as soon as they have been scanned.  Peak memory is
+    therefore bounded by the largest requested value rather than the whole
+    payload.
+
+    After load() returns, bytes_read and bytes_skipped describe the payload
+    that was parsed.
+
+    Arguments
+        keys -- iterable of top level keys to decode
+        chunk_size -- bytes to read at a time (default CHUNK_SIZE)
+    """
+    def __init__(self, keys, chunk_size=CHUNK_SIZE):
+        self.keys = frozenset(keys)
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.bytes_skipped = 0
+
+    def load(self, fp):
+        self._fp = fp
+        self._buf = ''
+        self._pos = 0
+        self.bytes_read = 0
+        self.bytes_skipped = 0
+        try:
+            return self._parse_object()
+        finally:
+            self._fp = None
+            self._buf = ''
+
+    def loads(self, s):
+        return self.load(_StringReader(s))
+
+    def _parse_object(self):
+        result = {}
+        self._skip_whitespace()
+        self._expect('{')
+        self._skip_whitespace()
+        if self._peek() == '}':
+            return result
+
+        while True:
+            self._skip_whitespace()
+            self._expect('"', consume=False)
+            key = self._decode(self._skip_string)
+            self._skip_whitespace()
+            self._expect(':')
+            self._skip_whitespace()
+            if key in self.keys:
+                result[key] = self._decode(self._skip_value)
+                if len(result) == len(self.keys):
+                    self._drain()
+                    return result
+            else:
+                start = self.bytes_read - len(self._buf) + self._pos
+                self._skip_value(discard=True)
+                self.bytes_skipped += self.bytes_read - len(self._buf) + self._pos - start
+            self._skip_whitespace()
+            c = self._peek()
+            self._pos += 1
+            if c == '}':
+                return result
+            if c != ',':
+                raise ValueError("Expected ',' or '}' at byte %d, got %r" % (self._offset() - 1, c))
+
+    def _decode(self, skip):
+        start = self._pos
+        skip(discard=False)
+        return json.loads(self._buf[start:self._pos])
+
+    def _skip_value(self, discard):
+        c = self._peek()
+        if c == '"':
+            self._skip_string(discard)
+        elif c == '{' or c == '[':
+            self._skip_container(discard)
+        else:
+            self._skip_scalar(discard)
+
+    def _skip_string(self, discard):
+        # Assumes the current character is the opening quote
+        m = _STRING.match(self._buf, self._pos)
+        if m is not None:
+            self._pos = m.end()
+            return
+        # The string continues past the buffered input
+        self._pos += 1
+        while True:
+            m = _STRING_SPECIAL.search(self._buf, self._pos)
+            if m is None:
+                self._pos = len(self._buf)
+                self._more(discard)
+                continue
+            if m.group() == '"':
+                self._pos = m.end()
+                return
+            # Skip the escaped character, which may not have been read yet
+            self._pos = m.end()
+            if self._pos >= len(self._buf):
+                self._more(discard)
+            self._pos += 1
+
+    def _skip_container(self, discard):
+        depth = 0
+        while True:
+            self._pos = _CONTAINER_RUN.match(self._buf, self._pos).end()
+            if self._pos >= len(self._buf):
+                self._more(discard)
+                continue
+            c = self._buf[self._pos]
+            if c == '"':
+                self._skip_string(discard)
+                continue
+            self._pos += 1
+            if c == '{' or c == '[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _skip_scalar(self, discard):
+        while True:
+            m = _SCALAR_END.search(self._buf, self._pos)
+            if m is not None:
+                self._pos = m.start()
+                return
+            self._pos = len(self._buf)
+            if not self._more(discard, required=False):
+                return
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._more(True, required=False):
+                return
+
+    def _peek(self):
+        if self._pos >= len(self._buf):
+            self._more(True)
+        return self._buf[self._pos]
+
+    def _expect(self, c, consume=True):
+        actual = self._peek()
+        if actual != c:
+            raise ValueError("Expected %r at byte %d, got %r" % (c, self._offset(), actual))
+        if consume:
+            self._pos += 1
+
+    def _offset(self):
+        return self.bytes_read - len(self._buf) + self._pos
+
+    def _more(self, discard, required=True):
+        """Reads the next chunk into the buffer
+
+        When discard is set, everything before the current position is
+        dropped first.  Returns False at the end of input, or raises
+        ValueError there when more input is required.
+        """
+        chunk = self._fp.read(self.chunk_size)
+        if not chunk:
+            if required:
+                raise ValueError("Unexpected end of JSON input at byte %d" % self._offset())
+            return False
+        self.bytes_read += len(chunk)
+        if discard:
+            self._buf = self._buf[self._pos:] + chunk
+            self._pos = 0
+        else:
+            self._buf += chunk
+        return True
+
+    def _drain(self):
+        # Every requested key was found; read the rest without scanning it so the connection can be reused
+        remaining = len(self._buf) - self._pos
+        self._buf = ''
+        self._pos = 0
+        while True:
+            chunk = self._fp.read(self.chunk_size)
+            if not chunk:
+                break
+            remaining += len(chunk)
+            self.bytes_read += len(chunk)
+        self.bytes_skipped += remaining
+
+class _RangeScanner(SelectiveJsonParser):
+    """Finds where the value of every top level key starts and ends in a string"""
+    def __init__(self):
+        super(_RangeScanner, self).__init__(())
+
+    def scan(self, s):
+        self._fp = _StringReader('')
+        self._buf = s
+        self._pos = 0
+        self.bytes_read = len(s)
+        try:
+            return self._scan_object()
+        finally:
+            self._fp = None
+            self._buf = ''
+
+    def _scan_object(self):
+        ranges = {}
+        self._skip_whitespace()
+        self._expect('{')
+        self._skip_whitespace()
+        if self._peek() == '}':
+            return ranges
+
+        while True:
+            self._skip_whitespace()
+            self._expect('"', consume=False)
+            key = self._decode(self._skip_string)
+            self._skip_whitespace()
+            self._expect(':')
+            self._skip_whitespace()
+            start = self._pos
+            self._skip_value(discard=False)
+            ranges[key] = (start, self._pos)
+            self._skip_whitespace()
+            c = self._peek()
+            self._pos += 1
+            if c == '}':
+                return ranges
+            if c != ',':
+                raise ValueError("Expected ',' or '}' at byte %d, got %r" % (self._offset() - 1, c))
+
+class _StringReader(object):
+    def __init__(self, s):
+        self.s = s
+        self.pos = 0
+
+    def read(self, size):
+        chunk = self.s[self.pos:self.pos + size]
+        self.pos += len(chunk)
+        return chunk
+
+def load_selected(fp, keys, chunk_size=CHUNK_SIZE):
+    """Parses the JSON object in fp, decoding only the given top level keys"""
+    return SelectiveJsonParser(keys, chunk_size).load(fp)
+
+def section_ranges(s):
+    """Returns {key: (start, end)} locating the raw value of each top level key of the JSON object in s"""
+    return _RangeScanner().scan(s)
@@ -0,0 +1,765 @@
+#!/usr/bin/python
+
+"""Tests of the collectors' building blocks
+
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import Queue
+import errno
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from StringIO import StringIO
+
+import mock
+
+mock.install_null_collectd('test')
+
+import fleet
+import jsonstream
+import util
+import vtgate_collectd
+import vttablet_collectd
+
+class RecordingCollectd(mock.CollectdNullMock):
+    """Collectd stand-in keeping every dispatched (plugin_instance, type_instance, values)"""
+    values_cls = None
+
+    def __init__(self):
+        mock.CollectdNullMock.__init__(self, 'test')
+        self.dispatched = []
+
+    def Values(self, plugin=None, plugin_instance=None, type=None, type_instance=None, values=None):
+        return (self.values_cls or RecordingValues)(self.dispatched, plugin_instance)
+
+    def drain(self):
+        dispatched = self.dispatched[:]
+        del self.dispatched[:]
+        return dispatched
+
+class RecordingValues(object):
+    def __init__(self, dispatched, plugin_instance):
+        self.dispatched = dispatched
+        self.plugin_instance = plugin_instance
+        self.type = None
+        self.type_instance = None
+        self.values = None
+
+    def dispatch(self):
+        self.dispatched.append((self.plugin_instance, self.type_instance, self.values))
+
+class TypedRecordingValues(RecordingValues):
+    def dispatch(self):
+        self.dispatched.append((self.type, self.type_instance, self.values))
+
+class CorpusTestCase(unittest.TestCase):
+    """Writes a generated vttablet payload to self.path"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.payload = fleet.FleetGenerator(vttablet_collectd.Vttablet).payload(0)
+        self.path = os.path.join(self.directory, 'vars.json')
+        with open(self.path, 'w') as f:
+            json.dump(self.payload, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+def free_port():
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+class FailingConnection(object):
+    """Pooled connection whose next request fails with error"""
+    sock = None
+
+    def __init__(self, error):
+        self.error = error
+
+    def request(self, method, path, headers=None):
+        raise self.error
+
+    def close(self):
+        pass
+
+def open_compressed(payload):
+    path = tempfile.mktemp(suffix=fleet.SUFFIX)
+    try:
+        fleet.write_payload(path, payload)
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
+
+class FleetTestCase(unittest.TestCase):
+    """Serves a generated vttablet payload at two free local ports"""
+    def setUp(self):
+        self.payload = fleet.FleetGenerator(vttablet_collectd.Vttablet).payload(0)
+        corpus = [fleet.CorpusEntry('0.json.gz', open_compressed(self.payload))]
+        self.ports = [free_port(), free_port()]
+        self.fleet = fleet.Fleet(corpus, self.ports)
+        self.fleet.start()
+
+    def tearDown(self):
+        self.fleet.stop()
+
+class DiscoveryTest(FleetTestCase):
+    def test_aliases_resolve_to_urls(self):
+        discovery = util.TargetDiscovery("http://127.0.0.1:%d/api/tablets/" % self.ports[0], timeout=5)
+        self.assertTrue(discovery.refresh())
+        self.assertEqual(discovery.urls, frozenset("http://127.0.0.1:%d/debug/vars" % port for port in self.ports))
+
+        provider = util.UrlJsonProvider.from_url(sorted(discovery.urls)[-1])
+        self.assertEqual(provider.get_json(), self.payload)
+
+    def test_discovered_targets_run_in_workers(self):
+        collectd = RecordingCollectd()
+        vt = vttablet_collectd.Vttablet(collectd)
+        vt.worker_processes = 1
+        vt.include_self_metrics = False
+        vt.discovery = util.TargetDiscovery("http://127.0.0.1:%d/api/tablets/" % self.ports[0], timeout=5)
+        vt.prepare()
+        vt.discovery.refresh()
+        vt.read_callback()
+
+        self.assertEqual(len(vt.targets), 2)
+        # Nothing was fetched in-process
+        self.assertEqual(vt.fetch_pool.fallback._threads, [])
+        for target in vt.targets:
+            self.assertEqual(target.health.state, util.TargetHealth.HEALTHY)
+            self.assertTrue(target.stats.values_emitted > 0)
+        self.assertEqual(len(collectd.drain()), sum(target.stats.values_emitted for target in vt.targets))
+
+        # A target that is gone is dropped by its worker, the others carry on
+        vt.discovery.urls = frozenset([vt.targets[0].json_provider.url()])
+        vt.read_callback()
+        self.assertEqual(len(vt.targets), 1)
+        self.assertEqual(len(collectd.drain()), vt.targets[0].stats.values_emitted)
+
+    def test_failed_refresh_keeps_urls(self):
+        discovery = util.TargetDiscovery("http://127.0.0.1:%d/api/tablets/" % self.ports[0], timeout=5)
+        discovery.refresh()
+        urls = discovery.urls
+        discovery.source = "http://127.0.0.1:%d/missing" % self.ports[0]
+        self.assertFalse(discovery.refresh())
+        self.assertEqual(discovery.urls, urls)
+
+class ConnectionPoolTest(FleetTestCase):
+    def open_after(self, error):
+        pool = util.HttpConnectionPool()
+        pool._idle[('127.0.0.1', self.ports[0])] = [FailingConnection(error)]
+        try:
+            response = pool.urlopen('127.0.0.1', self.ports[0], '/debug/vars', timeout=5)
+        except:
+            self.assertEqual(pool.reconnects, 0)
+            raise
+        self.assertEqual(json.load(response), self.payload)
+        response.close()
+        return pool
+
+    def test_dropped_connections_are_retried(self):
+        for error in (httplib.BadStatusLine("''"), socket.error(errno.ECONNRESET, "reset"),
+                      socket.error(errno.EPIPE, "broken pipe")):
+            self.assertEqual(self.open_after(error).reconnects, 1)
+
+    def test_timeouts_are_not_retried(self):
+        self.assertRaises(socket.timeout, self.open_after, socket.timeout("timed out"))
+        self.assertRaises(socket.error, self.open_after, socket.error(errno.ECONNREFUSED, "refused"))
+
+class JsonStreamTest(unittest.TestCase):
+    payload = {
+        'Skipped': {'a': [1, 2, {'b': "}]\"\\"}], 'c': None},
+        'Wanted': {'key.with "quotes"': [1.5, -2, True]},
+        'Scalar': 42,
+        'Text': "brace } and quote \" inside",
+        'Empty': {},
+    }
+
+    def test_load_selected(self):
+        s = json.dumps(self.payload, indent=2)
+        # A tiny chunk size makes every value straddle chunk boundaries
+        for chunk_size in (1, 7, jsonstream.CHUNK_SIZE):
+            data = jsonstream.load_selected(StringIO(s), ['Wanted', 'Text', 'Missing'], chunk_size)
+            self.assertEqual(data, {'Wanted': self.payload['Wanted'], 'Text': self.payload['Text']})
+
+    def test_load_selected_counts_skipped_bytes(self):
+        s = json.dumps(self.payload)
+        parser = jsonstream.SelectiveJsonParser(['Scalar'], chunk_size=16)
+        self.assertEqual(parser.load(StringIO(s)), {'Scalar': 42})
+        self.assertEqual(parser.bytes_read, len(s))
+        self.assertTrue(parser.bytes_skipped > len(json.dumps(self.payload['Skipped'])))
+
+    def test_section_ranges(self):
+        s = json.dumps(self.payload, indent=2)
+        ranges = jsonstream.section_ranges(s)
+        self.assertEqual(set(ranges), set(self.payload))
+        for key, (start, end) in ranges.iteritems():
+            self.assertEqual(json.loads(s[start:end]), self.payload[key])
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, jsonstream.load_selected, StringIO('{"a": 1 "b": 2}'), ['b'])
+        self.assertRaises(ValueError, jsonstream.section_ranges, '[1, 2]')
+
+class TagParserTest(unittest.TestCase):
+    def test_parse(self):
+        parser = util.TagParser(['table', 'plan', 'user'])
+        self.assertEqual(parser.parse('orders.Select Pk.app'), {'table': 'orders', 'plan': 'Select_Pk', 'user': 'app'})
+        # Vitess escapes periods in the last field, i.e. in usernames
+        self.assertEqual(parser.parse(r'orders.Insert.Foo-web\.hs-foo\.vitess'),
+                         {'table': 'orders', 'plan': 'Insert', 'user': 'Foo-web.hs-foo.vitess'})
+        self.assertRaises(Exception, parser.parse, 'orders.Insert')
+
+    def test_matches_extract_tags(self):
+        parser = util.TagParser(['keyspace', 'shard'], ':')
+        for key in ('ks:-80', 'ks:80-', 'other ks:0'):
+            self.assertEqual(parser.parse(key), util.extract_tags(key, ':', ['keyspace', 'shard']))
+
+    def test_cache_keeps_keys_in_use(self):
+        parser = util.TagParser(['a', 'b'], max_size=2)
+        first = parser.parse('x.1')
+        parser.parse('x.2')
+        parser.parse('x.3')
+        # x.1 moved to the previous generation, and is promoted back when looked up again
+        self.assertIs(parser.parse('x.1'), first)
+        self.assertIn('x.1', parser._current)
+        for key in ('x.4', 'x.5', 'x.6'):
+            parser.parse(key)
+        self.assertNotIn('x.2', parser._current)
+        self.assertNotIn('x.2', parser._previous)
+
+    def test_parsers_are_shared(self):
+        self.assertIs(util.get_tag_parser(['a', 'b']), util.get_tag_parser(('a', 'b')))
+        self.assertIsNot(util.get_tag_parser(['a', 'b']), util.get_tag_parser(['a', 'b'], ':'))
+
+class MetricEmitterTest(unittest.TestCase):
+    def setUp(self):
+        self.collectd = RecordingCollectd()
+
+    def read(self, emitter, timestamp, values, type='counter'):
+        emitter.begin_read()
+        emitter.timestamp = timestamp
+        for name, value in values:
+            emitter.emit(name, value, type, {'tag': 'x'})
+        emitter.flush()
+        return dict((type_instance, values[0]) for _, type_instance, values in self.collectd.drain())
+
+    def test_identities_are_rendered_once(self):
+        emitter = util.MetricEmitter(self.collectd, 'test')
+        emitter.emit('Queries', 1, 'counter', {'user': 'app', 'table': 'orders'})
+        emitter.emit('Queries', 2, 'counter', {'table': 'orders', 'user': 'app'})
+        self.assertEqual(self.collectd.drain(), [('test', 'vitess.test.Queries[table=orders,user=app]', [1]),
+                                                 ('test', 'vitess.test.Queries[table=orders,user=app]', [2])])
+        self.assertEqual(len(emitter._series), 1)
+
+    def test_state_survives_eviction(self):
+        emitter = util.MetricEmitter(self.collectd, 'test', max_identities=2, rates=True, raw_counters=False)
+        self.read(emitter, 100, [('A', 0), ('B', 0), ('C', 0)])
+        # Over max_identities, but every series was seen on the last read and keeps its last sample
+        self.assertEqual(len(self.read(emitter, 110, [('A', 10), ('B', 10), ('C', 10)])), 3)
+        for timestamp in range(120, 120 + 10 * util.IDENTITY_EXPIRY_READS, 10):
+            self.read(emitter, timestamp, [('A', timestamp)])
+        self.read(emitter, 200, [])
+        # B and C went unseen for IDENTITY_EXPIRY_READS reads, A and A.rate stay
+        self.assertEqual(sorted(key[0] for key in emitter._series), ['A', 'A.rate'])
+
+    def test_unchanged_values_are_suppressed(self):
+        emitter = util.MetricEmitter(self.collectd, 'test', heartbeat=60)
+        self.assertEqual(len(self.read(emitter, 100, [('A', 1), ('B', 2)], 'gauge')), 2)
+        self.assertEqual(self.read(emitter, 110, [('A', 1), ('B', 3)], 'gauge'), {'vitess.test.B[tag=x]': 3})
+        self.assertEqual((emitter.emitted, emitter.suppressed), (3, 1))
+
+    def test_heartbeat_resends_unchanged_values(self):
+        emitter = util.MetricEmitter(self.collectd, 'test', heartbeat=0)
+        self.read(emitter, 100, [('A', 1)], 'gauge')
+        self.assertEqual(self.read(emitter, 110, [('A', 1)], 'gauge'), {'vitess.test.A[tag=x]': 1})
+        self.assertEqual(emitter.suppressed, 0)
+
+    def test_rates_across_reads(self):
+        emitter = util.MetricEmitter(self.collectd, 'test', rates=True, deltas=True, raw_counters=False)
+        self.assertEqual(self.read(emitter, 100, [('Queries', 10)]), {})
+        self.assertEqual(self.read(emitter, 110, [('Queries', 60)]),
+                         {'vitess.test.Queries.rate[tag=x]': 5.0, 'vitess.test.Queries.delta[tag=x]': 50})
+        # A counter going backwards restarted from zero
+        self.assertEqual(self.read(emitter, 120, [('Queries', 20)]),
+                         {'vitess.test.Queries.rate[tag=x]': 2.0, 'vitess.test.Queries.delta[tag=x]': 20})
+        self.assertEqual(emitter.counter_resets, 1)
+
+class HistogramEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.collectd = RecordingCollectd()
+        self.emitter = util.MetricEmitter(self.collectd, 'test')
+
+    def histogram(self, counts, time=0):
+        # Cumulative counts of the 1ms, 5ms and 10ms buckets
+        histogram = dict(zip(['1000000', '5000000', '10000000'], counts))
+        histogram.update({'inf': counts[-1], 'Count': counts[-1], 'Time': time})
+        return histogram
+
+    def emit(self, engine, histogram, state=None, include_buckets=False):
+        engine.emit(self.emitter, 'MysqlExecTime', histogram, include_buckets=include_buckets, state=state)
+        return dict((type_instance, values[0]) for _, type_instance, values in self.collectd.drain())
+
+    def test_buckets(self):
+        engine = util.HistogramEngine()
+        emitted = self.emit(engine, self.histogram([10, 60, 100], time=2500000), include_buckets=True)
+        self.assertEqual(emitted, {
+            'vitess.test.MysqlExecTimeHistogram.1': 10,
+            'vitess.test.MysqlExecTimeHistogram.5': 60,
+            'vitess.test.MysqlExecTimeHistogram.10': 100,
+            'vitess.test.MysqlExecTimeHistogram.inf': 100,
+            'vitess.test.MysqlExecTimeHistogram.Count': 100,
+            'vitess.test.MysqlExecTimeHistogram.Time': 2.5,
+        })
+
+    def test_percentiles_interpolate_within_buckets(self):
+        engine = util.HistogramEngine([50, 99, 99.9])
+        emitted = self.emit(engine, self.histogram([10, 60, 100]))
+        self.assertAlmostEqual(emitted['vitess.test.MysqlExecTimeP50'], 1 + 4 * 40 / 50.0)
+        self.assertAlmostEqual(emitted['vitess.test.MysqlExecTimeP99'], 5 + 5 * 39 / 40.0)
+        self.assertIn('vitess.test.MysqlExecTimeP99_9', emitted)
+
+    def test_percentiles_over_the_interval(self):
+        engine = util.HistogramEngine([50])
+        state = {}
+        self.emit(engine, self.histogram([10, 60, 100]), state)
+        # The 100 observations since the last read all fell into the first bucket
+        self.assertEqual(self.emit(engine, self.histogram([110, 160, 200]), state), {'vitess.test.MysqlExecTimeP50': 0.5})
+        # Nothing observed since, so nothing to report
+        self.assertEqual(self.emit(engine, self.histogram([110, 160, 200]), state), {})
+        # After a restart the counts are taken as they are
+        self.assertEqual(self.emit(engine, self.histogram([0, 0, 4]), state), {'vitess.test.MysqlExecTimeP50': 5 + 5 * 2 / 4.0})
+
+    def test_overflow_is_the_largest_bound(self):
+        engine = util.HistogramEngine([50])
+        self.assertEqual(self.emit(engine, {'1000000': 0, '5000000': 0, 'inf': 10, 'Count': 10, 'Time': 0}),
+                         {'vitess.test.MysqlExecTimeP50': 5})
+
+class AsyncFetchPoolTest(FleetTestCase):
+    def fetch(self, pool, timeout=5):
+        results = Queue.Queue()
+        targets = []
+        for port in self.ports:
+            provider = util.AsyncUrlJsonProvider(host='127.0.0.1', port=port)
+            provider.timeout = timeout
+            targets.append(util.Target("vttablet_%d" % port, provider, None))
+            pool.submit(targets[-1], results)
+        fetched = dict((target, (data, error)) for target, data, error in [results.get(timeout=10) for _ in targets])
+        return [fetched[target] for target in targets]
+
+    def test_fetches_every_target(self):
+        pool = util.AsyncFetchPool(size=1)
+        for data, error in self.fetch(pool):
+            self.assertIsNone(error)
+            self.assertEqual(data, self.payload)
+
+    def test_slow_targets_time_out(self):
+        self.fleet.latency = 1.0
+        for data, error in self.fetch(util.AsyncFetchPool(), timeout=0.2):
+            self.assertIsInstance(error, socket.timeout)
+
+    def test_stagger_offsets_are_stable(self):
+        pool = util.AsyncFetchPool(stagger=2.0)
+        target = util.Target("vttablet_15101", None, None)
+        offset = pool.offset(target)
+        self.assertTrue(0 <= offset < 2.0)
+        self.assertEqual(pool.offset(util.Target("vttablet_15101", None, None)), offset)
+        self.assertEqual(util.AsyncFetchPool().offset(target), 0.0)
+
+    def test_stagger_leaves_time_to_fetch(self):
+        vt = vttablet_collectd.Vttablet(mock.CollectdNullMock('test'))
+        vt.deadline = 10.0
+        vt.stagger = 5.0
+        self.assertAlmostEqual(vt.fetch_stagger(), 10.0 - vt.fetch_timeout())
+        vt.stagger = 1.0
+        self.assertEqual(vt.fetch_stagger(), 1.0)
+
+class ServerFilterTest(FleetTestCase):
+    def provider(self):
+        provider = util.UrlJsonProvider(host='127.0.0.1', port=self.ports[0], timeout=5)
+        provider.server_filter = True
+        provider.keys = ['ConnCount', 'Queries']
+        self.expected = dict((key, self.payload[key]) for key in provider.keys)
+        # The first fetch is unfiltered, to learn the size of the whole payload
+        self.assertEqual(provider.get_json(), self.expected)
+        self.assertEqual(provider.request_path(), '/debug/vars?var=ConnCount&var=Queries')
+        return provider
+
+    def test_filtered_fetch(self):
+        provider = self.provider()
+        self.assertEqual(provider.get_json(), self.expected)
+        self.assertTrue(provider.filter_supported)
+        self.assertTrue(provider.bytes_saved > 0)
+
+    def test_falls_back_when_filters_are_ignored(self):
+        self.fleet.filter_param = 'ignored'
+        provider = self.provider()
+        self.assertEqual(provider.get_json(), self.expected)
+        self.assertIs(provider.filter_supported, False)
+        self.assertEqual(provider.bytes_saved, 0)
+        self.assertEqual(provider.request_path(), '/debug/vars')
+        self.assertEqual(provider.get_json(), self.expected)
+
+class CompressionTest(FleetTestCase):
+    def test_decompressing_reader(self):
+        body = json.dumps(self.payload)
+        for compressed in (open_compressed(self.payload), zlib.compress(body)):
+            reader = util.DecompressingReader(StringIO(compressed), chunk_size=100)
+            # Reads return at most what they ask for, however much input that takes
+            chunks = []
+            while True:
+                chunk = reader.read(1000)
+                self.assertTrue(len(chunk) <= 1000)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            self.assertEqual(json.loads(''.join(chunks)), self.payload)
+            self.assertEqual(reader.bytes_read, len(compressed))
+
+    def test_compressed_fetch(self):
+        provider = util.UrlJsonProvider(host='127.0.0.1', port=self.ports[0], timeout=5)
+        provider.compression = True
+        self.assertEqual(provider.get_json(), self.payload)
+        self.assertTrue(0 < provider.transfer_bytes < provider.response_bytes)
+
+    def test_compression_per_target(self):
+        vt = vttablet_collectd.Vttablet(mock.CollectdNullMock('test'))
+        vt.compression = 'remote'
+        vt.target_compression = {'tablet-2:15101': 'false', '15102': 'true'}
+        compression = {}
+        for host, port in (('tablet-1', 15101), ('tablet-2', 15101), ('localhost', 15101), ('localhost', 15102)):
+            provider = util.UrlJsonProvider(host=host, port=port)
+            vt._configure_provider(provider, None)
+            compression[host, port] = provider.compression
+        self.assertEqual(compression, {('tablet-1', 15101): True, ('tablet-2', 15101): False,
+                                       ('localhost', 15101): False, ('localhost', 15102): True})
+
+class TrackChangesTest(CorpusTestCase):
+    def test_unchanged_payload_transfers_nothing(self):
+        provider = util.FileJsonProvider(self.path)
+        provider.track_changes = True
+        self.assertEqual(set(provider.get_json()), set(self.payload))
+        provider.transfer_bytes = 1000
+        self.assertEqual(provider.get_json(), {})
+        self.assertEqual(provider.unchanged, frozenset(self.payload))
+        self.assertEqual(provider.transfer_bytes, 0)
+
+        provider.transfer_bytes = provider.bytes_saved = 1000
+        self.assertEqual(provider.not_modified(), {})
+        self.assertEqual((provider.response_bytes, provider.transfer_bytes, provider.bytes_saved), (0, 0, 0))
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+class PlanTest(unittest.TestCase):
+    """The compiled plan dispatches what the collectors did before it
+
+    testdata/<name>_expected.json holds what the collectors dispatched for
+    testdata/<name>_vars.json before the plan, with tags rendered sorted and
+    untagged timing histograms named after their key, as they are now.
+    """
+    def read(self, collector_cls, reads=1, **options):
+        collectd = RecordingCollectd()
+        collectd.values_cls = TypedRecordingValues
+        vt = collector_cls(collectd, util.FileJsonProvider(os.path.join(TESTDATA, '%s_vars.json' % vt_name(collector_cls))))
+        vt.include_self_metrics = False
+        for name, value in options.iteritems():
+            setattr(vt, name, value)
+        vt.prepare()
+        for _ in range(reads):
+            vt.read_callback()
+            dispatched = collectd.drain()
+        return sorted(dispatched)
+
+    def expected(self, collector_cls):
+        with open(os.path.join(TESTDATA, '%s_expected.json' % vt_name(collector_cls))) as f:
+            return sorted((type, type_instance, values) for type, type_instance, values in json.load(f))
+
+    def test_matches_baseline(self):
+        for collector_cls in (vttablet_collectd.Vttablet, vtgate_collectd.Vtgate):
+            self.assertEqual(self.read(collector_cls), self.expected(collector_cls))
+
+    def test_streaming_parse_matches_baseline(self):
+        for collector_cls in (vttablet_collectd.Vttablet, vtgate_collectd.Vtgate):
+            self.assertEqual(self.read(collector_cls, streaming_parse=True), self.expected(collector_cls))
+
+    def test_reused_sections_match_baseline(self):
+        # The second read replays every section
+        for collector_cls in (vttablet_collectd.Vttablet, vtgate_collectd.Vtgate):
+            self.assertEqual(self.read(collector_cls, reads=2, reuse_unchanged=True), self.expected(collector_cls))
+
+def vt_name(collector_cls):
+    return collector_cls.__name__.lower()
+
+class CardinalityLimiterTest(unittest.TestCase):
+    def select(self, limiter, values, type='counter'):
+        selected = limiter.select([({'table': name}, value) for name, value in sorted(values.iteritems())], type, ['table'])
+        return dict((tags['table'], value) for tags, value in selected)
+
+    def test_under_limit_passes_through(self):
+        limiter = util.CardinalityLimiter(3)
+        self.assertEqual(self.select(limiter, {'a': 1, 'b': 2}, 'gauge'), {'a': 1, 'b': 2})
+        self.assertEqual(limiter.folded, 0)
+
+    def test_top_series_are_kept(self):
+        limiter = util.CardinalityLimiter(2)
+        values = {'a': 100, 'b': 50, 'c': 1, 'd': 2}
+        self.select(limiter, values, 'gauge')
+        self.assertEqual(self.select(limiter, values, 'gauge'), {'a': 100, 'b': 50, util.OTHER_TAG_VALUE: 3})
+        self.assertEqual(limiter.folded, 2)
+
+    def test_heavy_hitter_replaces_weakest(self):
+        limiter = util.CardinalityLimiter(3)
+        totals = dict(('t%d' % i, 0) for i in range(6))
+        for read in range(10):
+            for i in range(6):
+                totals['t%d' % i] += 10 + i
+            if read >= 5:
+                totals['hot'] = totals.get('hot', 0) + 1000
+            selected = self.select(limiter, totals)
+            if read == 4:
+                before = set(selected)
+        self.assertIn('hot', selected)
+        # Only the weakest member made room
+        self.assertEqual(len(before - set(selected)), 1)
+
+    def test_close_rates_dont_churn(self):
+        limiter = util.CardinalityLimiter(2)
+        totals = dict.fromkeys('abcd', 0)
+        kept = set()
+        for read in range(20):
+            # Every series alternates between a rate of 10 and 12
+            for i, name in enumerate('abcd'):
+                totals[name] += 10 if (read + i) % 2 else 12
+            kept.add(frozenset(self.select(limiter, totals)))
+        self.assertEqual(len(kept), 1)
+
+    def test_other_counter_is_monotonic(self):
+        limiter = util.CardinalityLimiter(1)
+        totals = dict.fromkeys('abc', 0)
+        others = []
+        increases = 0
+        for read in range(12):
+            # The busiest series moves on every few reads
+            busy = 'abc'[read // 4]
+            for name in 'abc':
+                totals[name] += 100 if name == busy else 1
+            selected = self.select(limiter, totals)
+            if util.OTHER_TAG_VALUE in selected:
+                others.append(selected[util.OTHER_TAG_VALUE])
+                if len(others) > 1:
+                    increases += sum(100 if name == busy else 1 for name in 'abc' if name not in selected)
+        self.assertEqual(others, sorted(others))
+        self.assertTrue(others[-1] > 100)
+        self.assertEqual(others[-1] - others[0], increases)
+
+class HungJsonProvider(util.JsonProvider):
+    """Provider whose fetches hang until released"""
+    def __init__(self):
+        self.released = threading.Event()
+
+    def get_json(self):
+        self.released.wait(10)
+        return {}
+
+class SlowVttablet(vttablet_collectd.Vttablet):
+    """Vttablet taking delay seconds more to process each target"""
+    delay = 0.0
+
+    def process_data(self, json_data):
+        vttablet_collectd.Vttablet.process_data(self, json_data)
+        time.sleep(self.delay)
+
+class ReadDeadlineTest(CorpusTestCase):
+    def collector(self, providers, delay=0.0):
+        vt = SlowVttablet(mock.CollectdNullMock('test'))
+        vt.delay = delay
+        vt.deadline = 0.5
+        vt.include_self_metrics = False
+        vt.targets = [util.Target("vttablet_%d" % i, provider, util.MetricEmitter(vt.collectd, "vttablet_%d" % i))
+                      for i, provider in enumerate(providers)]
+        vt.prepare()
+        return vt
+
+    def test_answered_targets_are_processed_past_the_deadline(self):
+        # Processing the targets takes longer than the deadline, but each one answered in time
+        vt = self.collector([util.FileJsonProvider(self.path) for _ in range(3)], delay=0.3)
+        vt.read_callback()
+        for target in vt.targets:
+            self.assertEqual(target.health.state, util.TargetHealth.HEALTHY)
+            self.assertTrue(target.stats.values_emitted > 0)
+
+    def test_hung_targets_are_backed_off(self):
+        hung = HungJsonProvider()
+        vt = self.collector([util.FileJsonProvider(self.path), hung])
+        try:
+            start = time.time()
+            vt.read_callback()
+            self.assertTrue(time.time() - start < 1.0)
+            healthy, failing = vt.targets
+            self.assertEqual(healthy.health.state, util.TargetHealth.HEALTHY)
+            self.assertEqual(failing.health.state, util.TargetHealth.FAILING)
+            self.assertEqual(failing.stats.fetch_errors, 1)
+            self.assertFalse(failing.health.should_fetch(time.time()))
+        finally:
+            hung.released.set()
+
+class CycleBudgetTest(CorpusTestCase):
+    def test_budget_is_shared_by_the_targets_of_a_read(self):
+        vt = SlowVttablet(mock.CollectdNullMock('test'))
+        vt.delay = 0.3
+        vt.cycle_budget = 0.2
+        vt.include_self_metrics = False
+        vt.fetch_pool = util.FetchPool(1)
+        vt.targets = [util.Target("vttablet_%d" % i, util.FileJsonProvider(self.path), util.MetricEmitter(vt.collectd, "vttablet_%d" % i))
+                      for i in range(3)]
+        vt.prepare()
+        vt.read_callback()
+
+        first, second, third = vt.targets
+        self.assertEqual(first.stats.steps_deferred, 0)
+        # The first target spent the read's budget, so only the core tier of the others ran
+        detail = [i for i, step in enumerate(vt.plan) if step.tier != util.TIER_CORE]
+        self.assertEqual(sorted(second.deferred), detail)
+        self.assertEqual(sorted(third.deferred), detail)
+
+class GroupIntervalTest(CorpusTestCase):
+    def table_sizes(self, **options):
+        collectd = RecordingCollectd()
+        vt = vttablet_collectd.Vttablet(collectd, util.FileJsonProvider(self.path))
+        vt.include_self_metrics = False
+        vt.group_intervals = {'TableSizes': 3}
+        for name, value in options.iteritems():
+            setattr(vt, name, value)
+        vt.prepare()
+        counts = []
+        for read in range(7):
+            vt.read_callback()
+            counts.append(len([1 for _, type_instance, _ in collectd.drain() if '.DataLength[' in type_instance]))
+        return counts
+
+    def test_groups_are_collected_every_n_reads(self):
+        tables = len(self.payload['DataLength'])
+        self.assertEqual(self.table_sizes(), [tables, 0, 0, tables, 0, 0, tables])
+
+    def test_reused_groups_are_decoded_when_due(self):
+        tables = len(self.payload['DataLength'])
+        self.assertEqual(self.table_sizes(reuse_unchanged=True), [tables, 0, 0, tables, 0, 0, tables])
+
+class ProcessPoolTest(CorpusTestCase):
+    def test_every_read_is_dispatched(self):
+        collectd = RecordingCollectd()
+        vt = vttablet_collectd.Vttablet(collectd, util.FileJsonProvider(self.path))
+        vt.worker_processes = 1
+        vt.include_self_metrics = False
+        vt.prepare()
+        self.assertIsInstance(vt.fetch_pool, util.ProcessPool)
+
+        vt.read_callback()
+        first = collectd.drain()
+        vt.read_callback()
+        second = collectd.drain()
+        self.assertTrue(first)
+        self.assertEqual(len(second), len(first))
+        self.assertEqual(vt.targets[0].stats.values_emitted, len(second))
+
+class FetchCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = util.FetchCache()
+        self.fetches = 0
+
+    def fetch(self, data='payload', size=10):
+        def fetch():
+            self.fetches += 1
+            return data, size
+        return fetch
+
+    def test_hit_within_ttl(self):
+        self.assertEqual(self.cache.get('a', self.fetch(), 60), ('payload', False))
+        self.assertEqual(self.cache.get('a', self.fetch(), 60), ('payload', True))
+        self.assertEqual(self.fetches, 1)
+        # A reader accepting nothing older than 0 seconds fetches again
+        self.assertEqual(self.cache.get('a', self.fetch('fresh'), 0), ('fresh', False))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['bytes']), (1, 2, 10))
+
+    def test_errors_are_not_cached(self):
+        def fail():
+            raise IOError("refused")
+        self.assertRaises(IOError, self.cache.get, 'a', fail, 60)
+        self.assertEqual(self.cache.get('a', self.fetch(), 60), ('payload', False))
+        self.assertEqual(self.fetches, 1)
+
+    def test_fetch_in_flight_is_shared(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch():
+            started.set()
+            release.wait(5)
+            return self.fetch()()
+
+        results = []
+        owner = threading.Thread(target=lambda: results.append(self.cache.get('a', slow_fetch, 60)))
+        owner.start()
+        started.wait(5)
+        waiter = threading.Thread(target=lambda: results.append(self.cache.get('a', self.fetch('other'), 60)))
+        waiter.start()
+        release.set()
+        owner.join(5)
+        waiter.join(5)
+
+        self.assertEqual(sorted(results), [('payload', False), ('payload', True)])
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.cache.stats()['shared'], 1)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = util.FetchCache(max_bytes=25, max_entries=3)
+        cache.get('a', self.fetch('a'), 60)
+        cache.get('b', self.fetch('b'), 60)
+        cache.get('a', self.fetch('a'), 60)
+        # Over max_bytes, so b, the least recently used, goes
+        cache.get('c', self.fetch('c'), 60)
+        self.assertEqual(cache.get('a', self.fetch(), 60), ('a', True))
+        self.assertEqual(cache.get('b', self.fetch('b2'), 60), ('b2', False))
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+class SharedFetchCacheTest(FleetTestCase):
+    def setUp(self):
+        super(SharedFetchCacheTest, self).setUp()
+        self.saved_cache = util.fetch_cache
+        util.fetch_cache = util.FetchCache()
+
+    def tearDown(self):
+        util.fetch_cache = self.saved_cache
+        super(SharedFetchCacheTest, self).tearDown()
+
+    def collector(self, collectd):
+        vt = vttablet_collectd.Vttablet(collectd)
+        vt.fetch_cache_ttl = 60
+        vt.targets = [vt.create_target(util.UrlJsonProvider(host='127.0.0.1', port=self.ports[0], timeout=5))]
+        vt.prepare()
+        return vt
+
+    def test_stats_are_reported_once(self):
+        collectds = [RecordingCollectd(), RecordingCollectd()]
+        collectors = [self.collector(collectd) for collectd in collectds]
+        for vt in collectors * 2:
+            vt.read_callback()
+        reported = [[type_instance for _, type_instance, _ in collectd.drain() if '.FetchCache' in type_instance]
+                    for collectd in collectds]
+        self.assertTrue(reported[0])
+        self.assertEqual(reported[1], [])
+        self.assertEqual(util.fetch_cache.stats()['hits'], 3)
+
+if __name__ == '__main__':
+    unittest.main()
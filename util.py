@@ -3,16 +3,67 @@
 import abc
 import sys
 import time
+import urllib
 import urllib2
+import httplib
+import socket
 import json
 import os
 import logging
 import re
+import threading
+import random
+import heapq
+import operator
+import Queue
+import urlparse
+import select
+import errno
+import zlib
+import multiprocessing
+import hashlib
+import collections
+from cStringIO import StringIO
 import mock
-import re
-
-MAX_ATTEMPTS = 6
-SLEEP_TIME = 10
+import jsonstream
+
+# Number of threads fetching /debug/vars concurrently when a collector polls several targets
+DEFAULT_FETCH_THREADS = 8
+# Default per-cycle deadline (seconds) when no Interval is configured, matching collectd's default interval
+DEFAULT_DEADLINE = 10
+# Share of the read deadline a single fetch may take, leaving the rest for the timeout to be handled
+FETCH_TIMEOUT_RATIO = 0.8
+# Backoff (seconds) applied to a failing target, doubled on each consecutive failure up to BACKOFF_MAX
+BACKOFF_BASE = 10
+BACKOFF_MAX = 300
+# Idle keep-alive connections kept open per host:port
+MAX_IDLE_CONNECTIONS = 4
+# Bounds on the payloads kept by the process wide FetchCache, by summed response size and by count
+FETCH_CACHE_MAX_BYTES = 256 * 1024 * 1024
+FETCH_CACHE_MAX_ENTRIES = 1024
+# Parsed keys cached per tag list; key sets barely change between intervals
+TAG_CACHE_SIZE = 50000
+# Rendered metric identities (and their collectd.Values) cached per emitter before stale ones are evicted
+IDENTITY_CACHE_SIZE = 100000
+# Reads a cached series may go unseen before it is evicted
+IDENTITY_EXPIRY_READS = 5
+NOTICE = 25
+# Seconds after which an unchanged value is dispatched again when suppressing unchanged values
+DEFAULT_HEARTBEAT = 300
+# Per interval decay of the scores CardinalityLimiter ranks series by
+LIMITER_DECAY = 0.5
+# A series kept by CardinalityLimiter is only replaced by one scoring this many times higher
+LIMITER_HYSTERESIS = 1.5
+# Tag value of the series that CardinalityLimiter folds everything else into
+OTHER_TAG_VALUE = 'other'
+# Reserved prefix for metrics about the collector itself
+SELF_METRICS_PREFIX = 'Collector.'
+# Seconds between refreshes of discovered targets
+DEFAULT_DISCOVERY_INTERVAL = 60
+# Priority tiers of plan steps.  When a read runs out of CycleBudget, steps above TIER_CORE are deferred
+TIER_CORE = 0
+TIER_TIMINGS = 1
+TIER_DETAIL = 2
 
 class CollectdLogHandler(logging.Handler):
     """Log handler to forward statements to collectd
@@ -38,10 +89,12 @@ class CollectdLogHandler(logging.Handler):
         self.collectd = collectd
         self.verbose = verbose
         self.plugin = plugin
-        logging.Handler.__init__(self, level=logging.NOTSET)
+        logging.Handler.__init__(self, level=logging.DEBUG if verbose else NOTICE)
 
     def register(self):
         logger.addHandler(self)
+        # Checked once here, so info and debug statements are discarded before being formatted unless needed
+        logger.setLevel(min(logger.level, self.level))
 
     def emit(self, record):
         """
@@ -52,16 +105,17 @@ class CollectdLogHandler(logging.Handler):
         """
         try:
             if record.msg is not None:
+                msg = record.getMessage()
                 if record.levelname == 'ERROR':
-                    self.collectd.error('%s : %s' % (self.plugin, record.msg))
+                    self.collectd.error('%s : %s' % (self.plugin, msg))
                 elif record.levelname == 'WARNING':
-                    self.collectd.warning('%s : %s' % (self.plugin, record.msg))
+                    self.collectd.warning('%s : %s' % (self.plugin, msg))
                 elif record.levelname == 'NOTICE':
-                    self.collectd.notice('%s : %s' % (self.plugin, record.msg))
+                    self.collectd.notice('%s : %s' % (self.plugin, msg))
                 elif record.levelname == 'INFO' and self.verbose is True:
-                    self.collectd.info('%s : %s' % (self.plugin, record.msg))
+                    self.collectd.info('%s : %s' % (self.plugin, msg))
                 elif record.levelname == 'DEBUG' and self.verbose is True:
-                    self.collectd.debug('%s : %s' % (self.plugin, record.msg))
+                    self.collectd.debug('%s : %s' % (self.plugin, msg))
         except Exception as e:
             self.collectd.warning(('{p} [ERROR]: Failed to write log statement due '
                               'to: {e}').format(p=self.plugin,
@@ -87,42 +141,91 @@ class CollectdLogger(logging.Logger):
         level -- log level to filter by
         """
         logging.Logger.__init__(self, name, level)
-        logging.addLevelName(25, 'NOTICE')
+        logging.addLevelName(NOTICE, 'NOTICE')
 
-    def notice(self, msg):
+    def notice(self, msg, *args):
         """Logs a 'NOTICE' level statement at level 25
 
         Arguments
         msg - log statement to be logged as 'NOTICE'
+        args - arguments to lazily format msg with
         """
-        self.log(25, msg)
+        self.log(NOTICE, msg, *args)
 
-# Set up logging
+# Set up logging. The level is lowered as handlers needing info or debug statements are registered
 logging.setLoggerClass(CollectdLogger)
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(NOTICE)
 logger.propagate = False
 
+class Tracer(object):
+    """Debug tracing of method calls and read cycle phases
+
+    Tracing is off by default, in which case callers skip it by checking
+    enabled and phase() hands out a shared no-op context manager, so
+    nothing is formatted or timed.  Once enabled, entry()/leave() log method
+    calls and each phase logs how long it took at debug level.
+    """
+    def __init__(self):
+        self.enabled = False
+
+    def phase(self, name, label):
+        """Returns a context manager timing phase name of label, i.e. 'fetch' of a target"""
+        if not self.enabled:
+            return _NULL_PHASE
+        return _TracedPhase(name, label)
+
+class _TracedPhase(object):
+    __slots__ = ('name', 'label', 'start')
+
+    def __init__(self, name, label):
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        logger.debug("Phase %s of %s took %.2fms", self.name, self.label, (time.time() - self.start) * 1000)
+        return False
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+tracer = Tracer()
+
 def log(message):
     logger.info(message)
 
-def entry(method_name):
-    logger.debug("In: " + method_name)
+def entry(method_name, *args):
+    if tracer.enabled:
+        logger.debug("In: " + method_name, *args)
 
 
-def leave(method_name):
-    logger.debug("Out: " + method_name)
+def leave(method_name, *args):
+    if tracer.enabled:
+        logger.debug("Out: " + method_name, *args)
 
 
 def get_json_data(url):
     response = None
     try:
-        logger.info('Fetching api information from: %s' % url)
-        request = urllib2.Request(url)
-        response = urllib2.urlopen(request, timeout=10)
-        logger.debug('Raw api response: %s' % response)
+        logger.info('Fetching api information from: %s', url)
+        parsed = urlparse.urlparse(url)
+        path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        response = connection_pool.urlopen(parsed.hostname, parsed.port or 80, path, timeout=10)
+        logger.debug('Raw api response: %s', response)
         return json.load(response)
-    except (urllib2.URLError, urllib2.HTTPError), e:
+    except (httplib.HTTPException, socket.error), e:
         logger.error('Error connecting to %s - %r : %s' %
                      (url, e, e))
         return None
@@ -189,36 +292,101 @@ def extract_tagged_values(data, name, key_split_char='.', tag_list=None):
     if not tag_list:
         return [(dict(), value) for value in values.values()]
 
+    parse = get_tag_parser(tag_list, key_split_char).parse
     if type(values) is not dict:
-        return [(_extract_tags(name, key_split_char, tag_list), values)]
+        return [(parse(name), values)]
 
-    result = []
-    for key, value in values.items():
-        result.append((_extract_tags(key, key_split_char, tag_list), value))
-    return result
+    return [(parse(key), value) for key, value in values.iteritems()]
 
 def _extract_tags(name, key_split_char='.', tag_list=None):
     if not tag_list:
         return dict()
-    tag_data = []
-    try:
+    return get_tag_parser(tag_list, key_split_char).parse(name)
+
+class TagParser(object):
+    """Splits keys like table.user.type into a dict of tags
+
+    The splitter is compiled once per separator, and parsed keys are kept in
+    a bounded cache since the same keys show up every interval.  The cache
+    approximates LRU with two generations: once the current generation is
+    full it replaces the previous one, and keys still in use are promoted
+    back into the current generation when they're next looked up.
+
+    The returned dicts are shared between calls and must not be modified.
+
+    Arguments
+        tag_list -- names of the tags, in the order they appear in keys
+        key_split_char -- separator between tags (default '.')
+        max_size -- keys cached per generation (default TAG_CACHE_SIZE)
+    """
+    def __init__(self, tag_list, key_split_char='.', max_size=TAG_CACHE_SIZE):
+        self.tag_list = tuple(tag_list)
+        self.max_size = max_size
+        self._current = {}
+        self._previous = {}
         if key_split_char == '.' or key_split_char == '\\':
             # names may have escaped periods or slashes, i.e. in usernames, like Foo-web.hs-foo.vitess
             # in that case, vitess escapes them with a backslash. We don't want to count those escaped characters
             # when splitting. This regex only splits on non-escaped periods/slashes.
-            tag_data = re.split(r'(?<!\\)%s' % re.escape(key_split_char), name)
-            # Unescape them.
-            tag_data[-1] = tag_data[-1].replace(r'\.', '.').replace(r'\\', '\\')
+            self._split = re.compile(r'(?<!\\)%s' % re.escape(key_split_char)).split
+            self._unescape = True
         else:
             # Otherwise just do a straight split.
-            tag_data = name.split(key_split_char)
-    except:
-        tag_data = name.split(key_split_char)
+            self._split = lambda name: name.split(key_split_char)
+            self._unescape = False
+
+    def parse(self, name):
+        tags = self._current.get(name)
+        if tags is None:
+            tags = self._previous.get(name)
+            if tags is None:
+                tags = self._parse(name)
+            if len(self._current) >= self.max_size:
+                self._previous = self._current
+                self._current = {}
+            self._current[name] = tags
+        return tags
 
-    if len(tag_data) != len(tag_list):
-        raise Exception("Data not as expected for %s tag list: %s; data: %s" % (name, str(tag_list), str(tag_data)))
-    return dict(zip(tag_list, [x.replace(" ", "_") for x in tag_data]))
+    def _parse(self, name):
+        tag_data = self._split(name)
+        if self._unescape:
+            tag_data[-1] = tag_data[-1].replace(r'\.', '.').replace(r'\\', '\\')
 
+        if len(tag_data) != len(self.tag_list):
+            raise Exception("Data not as expected for %s tag list: %s; data: %s" % (name, str(list(self.tag_list)), str(tag_data)))
+        return dict(zip(self.tag_list, [x.replace(" ", "_") for x in tag_data]))
+
+_tag_parsers = {}
+
+def get_tag_parser(tag_list, key_split_char='.'):
+    """Returns the shared TagParser for tag_list and key_split_char"""
+    key = (key_split_char, tuple(tag_list))
+    parser = _tag_parsers.get(key)
+    if parser is None:
+        parser = _tag_parsers.setdefault(key, TagParser(tag_list, key_split_char))
+    return parser
+
+
+def parse_ports(values):
+    """Expands Port config values into a list of port strings
+
+    Each value may be a single port (15101), a comma separated list
+    ("15101,15102") or an inclusive range ("15101-15140").
+    """
+    ports = []
+    for value in values:
+        if isinstance(value, float):
+            value = "%d" % value
+        for part in str(value).split(','):
+            part = part.strip()
+            if not part:
+                continue
+            if '-' in part:
+                start, end = part.split('-', 1)
+                ports.extend([str(p) for p in range(int(start), int(end) + 1)])
+            else:
+                ports.append(part)
+    return ports
 
 def default_extractor(data, name):
     return [(dict(), data[name])]
@@ -226,6 +394,11 @@ def default_extractor(data, name):
 def nsToMs(ns):
     return ns / 1000000.0
 
+# Value transformers metric specs can refer to by name
+TRANSFORMERS = {
+    'nsToMs': nsToMs,
+}
+
 def boolval(val):
         return val.__str__().lower() == 'true'
 
@@ -234,9 +407,288 @@ def upperSnakeToCamel(val):
         return val.title().replace('_', '')
     return val
 
+class HttpConnectionPool(object):
+    """Keeps HTTP/1.1 keep-alive connections open between fetches
+
+    Connections are pooled per host:port and handed out to one request at a
+    time.  A pooled connection the server has since closed is replaced by a
+    fresh one transparently.  Counters of requests made and connections
+    reused are kept so the pool's effectiveness can be reported.
+
+    Arguments
+        max_idle -- idle connections kept per host:port (default MAX_IDLE_CONNECTIONS)
+    """
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.reused = 0
+        self.reconnects = 0
+
+    def urlopen(self, host, port, path, timeout=DEFAULT_DEADLINE, headers=None):
+        """Issues a GET for path and returns a file-like PooledResponse
+
+        Raises httplib.HTTPException for responses other than 200 and 304
+        (Not Modified, for conditional requests).  The response must be
+        closed to hand its connection back to the pool.
+        """
+        key = (host, int(port))
+        conn, reused = self._checkout(key, timeout)
+        try:
+            try:
+                response = self._request(conn, path, headers)
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if not reused or not _connection_dropped(e):
+                    raise
+                # The server dropped an idle keep-alive connection, retry once on a fresh one
+                with self._lock:
+                    self.reconnects += 1
+                conn = httplib.HTTPConnection(host, int(port), timeout=timeout)
+                response = self._request(conn, path, headers)
+        except:
+            conn.close()
+            raise
+
+        if response.status not in (200, 304):
+            response.read()
+            conn.close()
+            raise httplib.HTTPException("HTTP %d %s from http://%s:%s%s" % (response.status, response.reason, host, port, path))
+        return PooledResponse(self, key, conn, response)
+
+    def stats(self):
+        with self._lock:
+            ratio = float(self.reused) / self.requests if self.requests else 0.0
+            return {'requests': self.requests, 'reused': self.reused, 'reconnects': self.reconnects, 'reuse_ratio': ratio}
+
+    def _request(self, conn, path, headers=None):
+        request_headers = {'Connection': 'keep-alive'}
+        if headers:
+            request_headers.update(headers)
+        conn.request("GET", path, headers=request_headers)
+        return conn.getresponse()
+
+    def _checkout(self, key, timeout):
+        with self._lock:
+            self.requests += 1
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                self.reused += 1
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.timeout = timeout
+                return conn, True
+        return httplib.HTTPConnection(key[0], key[1], timeout=timeout), False
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+def _connection_dropped(e):
+    """Returns whether e is how a request on a connection the server has since closed fails
+
+    Timeouts and other errors are left alone, so a slow target isn't asked twice.
+    """
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    return isinstance(e, socket.error) and not isinstance(e, socket.timeout) and e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+class PooledResponse(object):
+    """File-like wrapper returning its connection to the pool on close
+
+    The connection is only reused when the body was read completely and the
+    server didn't ask to close it.
+    """
+    def __init__(self, pool, key, conn, response):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def getcode(self):
+        return self.response.status
+
+    def info(self):
+        return self.response.msg
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool._checkin(self.key, self.conn)
+        else:
+            self.response.close()
+            self.conn.close()
+        self.conn = None
+
+# Shared by every provider in the interpreter, so connections are reused across collectors
+connection_pool = HttpConnectionPool()
+
+class FetchCache(object):
+    """Parsed /debug/vars payloads shared by every collector in the interpreter
+
+    With Globals true, several vtgate and vttablet modules share one python
+    interpreter and may poll the same urls.  Payloads are cached by url and
+    requested keys, and a fetch of a key already in flight is waited on
+    rather than repeated, so concurrent reads of a url share one fetch and
+    one parse.  Each reader decides how old a payload it accepts.  Once the
+    cached payloads' response sizes add up to more than max_bytes, or there
+    are more than max_entries of them, the least recently used are evicted.
+
+    Cached payloads are shared between readers and must not be modified.
+
+    Arguments
+        max_bytes -- bound on the summed response size of cached payloads (default FETCH_CACHE_MAX_BYTES)
+        max_entries -- bound on the number of cached payloads (default FETCH_CACHE_MAX_ENTRIES)
+    """
+    def __init__(self, max_bytes=FETCH_CACHE_MAX_BYTES, max_entries=FETCH_CACHE_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        self._reporter = None
+
+    def get(self, key, fetch, ttl, timeout=DEFAULT_DEADLINE):
+        """Returns (data, hit), the payload of key fetched less than ttl seconds ago
+
+        On a miss fetch() is called and must return (data, size).  Errors it
+        raises are passed on to every reader waiting on it, and aren't cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.ready.is_set() and entry.fetched + ttl <= time.time():
+                self.bytes -= entry.size
+                entry = None
+            if entry is None:
+                entry = _FetchCacheEntry()
+                self.misses += 1
+            elif entry.ready.is_set():
+                self.hits += 1
+            else:
+                self.shared += 1
+            # Re-inserted last as the most recently used
+            self._entries[key] = entry
+            owner = entry.owner is None
+            if owner:
+                entry.owner = threading.current_thread()
+
+        if owner:
+            return self._fetch(key, entry, fetch), False
+        if not entry.ready.wait(timeout):
+            raise IOError("Timed out waiting on a fetch of %s in flight" % (key[0],))
+        if entry.error is not None:
+            raise entry.error
+        return entry.data, True
+
+    def _fetch(self, key, entry, fetch):
+        try:
+            data, size = fetch()
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry.ready.set()
+            raise
+        entry.data = data
+        entry.size = size
+        entry.fetched = time.time()
+        with self._lock:
+            if self._entries.get(key) is entry:
+                self.bytes += size
+                self._evict()
+        entry.ready.set()
+        return data
+
+    def _evict(self):
+        # Oldest first; fetches still in flight have no size yet and are left alone
+        for key, entry in self._entries.items():
+            if self.bytes <= self.max_bytes and len(self._entries) <= self.max_entries:
+                return
+            if entry.ready.is_set():
+                del self._entries[key]
+                self.bytes -= entry.size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.ready.is_set():
+                    del self._entries[key]
+                    self.bytes -= entry.size
+
+    def reports(self, collector):
+        """Returns whether collector reports the stats, the first collector to ask does
+
+        The stats are of the whole interpreter, so reporting them from every
+        collector sharing the cache would only repeat them.
+        """
+        with self._lock:
+            if self._reporter is None:
+                self._reporter = collector
+            return self._reporter is collector
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared + self.misses
+            ratio = float(self.hits + self.shared) / lookups if lookups else 0.0
+            return {'hits': self.hits, 'misses': self.misses, 'shared': self.shared, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.bytes, 'hit_ratio': ratio}
+
+class _FetchCacheEntry(object):
+    __slots__ = ('ready', 'owner', 'data', 'size', 'fetched', 'error')
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.owner = None
+        self.data = None
+        self.size = 0
+        self.fetched = 0.0
+        self.error = None
+
+# Shared by every collector in the interpreter that sets FetchCacheTTL
+fetch_cache = FetchCache()
+
 class JsonProvider(object):
     __metaclass__ = abc.ABCMeta
 
+    # Top level keys to parse, or None to parse everything
+    keys = None
+    # Details of the last get_json(); parse_time includes reading the body
+    fetch_time = 0.0
+    parse_time = 0.0
+    response_bytes = 0
+    # With track_changes set, top level keys whose raw value is the same as
+    # in the previous payload are left out of the parsed json and listed in
+    # unchanged instead, so their previous results can be reused
+    track_changes = False
+    unchanged = frozenset()
+    # ETag of the last response, sent back as If-None-Match when tracking changes
+    etag = None
+    # Bytes of the last payload not downloaded thanks to server side filtering
+    bytes_saved = 0
+    # Bytes of the last payload as transferred, less than response_bytes when it was compressed
+    transfer_bytes = 0
+    _digest = None
+    _section_digests = {}
+
     @abc.abstractmethod
     def get_json(self):
         """
@@ -244,108 +696,2028 @@ class JsonProvider(object):
         """
         return
 
+    def load(self, fp):
+        """Parses json from fp
+
+        When keys is set, only those top level keys are decoded using a
+        streaming parser and everything else is skipped unparsed.
+        """
+        start = time.time()
+        reader = CountingReader(fp)
+        try:
+            if self.track_changes:
+                return self._load_changes(reader.read())
+            if self.keys is None:
+                return json.load(reader)
+            return jsonstream.load_selected(reader, self.keys)
+        finally:
+            self.parse_time = time.time() - start
+            self.response_bytes = reader.bytes_read
+
+    def forget(self, sections):
+        """Forgets the digests of sections, so the next payload decodes them even if unchanged
+
+        The ETag and the digest of the whole payload are forgotten as well,
+        as either would have the next read skip decoding altogether.
+        """
+        self._section_digests = dict((key, digest) for key, digest in self._section_digests.iteritems() if key not in sections)
+        self._digest = None
+        self.etag = None
+
+    def not_modified(self):
+        """Returns the (empty) json of a payload known to be unchanged, i.e. after HTTP 304"""
+        self.unchanged = frozenset(self._section_digests)
+        self.response_bytes = 0
+        self.transfer_bytes = 0
+        self.bytes_saved = 0
+        self.parse_time = 0.0
+        return {}
+
+    def _load_changes(self, raw):
+        digest = hashlib.sha1(raw).digest()
+        if digest == self._digest:
+            self.unchanged = frozenset(self._section_digests)
+            self.transfer_bytes = 0
+            return {}
+        ranges = jsonstream.section_ranges(raw)
+        previous = self._section_digests
+        digests = {}
+        unchanged = set()
+        data = {}
+        for key, (start, end) in ranges.iteritems():
+            if self.keys is not None and key not in self.keys:
+                continue
+            section_digest = digests[key] = hashlib.sha1(buffer(raw, start, end - start)).digest()
+            if previous.get(key) == section_digest:
+                unchanged.add(key)
+            else:
+                data[key] = json.loads(raw[start:end])
+        self._digest = digest
+        self._section_digests = digests
+        self.unchanged = frozenset(unchanged)
+        return data
+
+class DecompressingReader(object):
+    """File-like wrapper decompressing a gzip or zlib (deflate) encoded stream as it is read
+
+    Only as much input is decompressed as each read() asks for, so a
+    streaming parser reading in chunks never holds the whole decompressed
+    body.  bytes_read counts the compressed bytes read from fp.
+    """
+    def __init__(self, fp, chunk_size=jsonstream.CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        # 32 + MAX_WBITS detects a gzip or zlib header
+        self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self._eof = False
+
+    def read(self, size=-1):
+        out = []
+        n = 0
+        while (size < 0 or n < size) and not self._eof:
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self.fp.read(self.chunk_size)
+                if not data:
+                    out.append(self._decompressor.flush())
+                    self._eof = True
+                    break
+                self.bytes_read += len(data)
+            piece = self._decompressor.decompress(data, size - n if size >= 0 else 0)
+            out.append(piece)
+            n += len(piece)
+        return ''.join(out)
+
+class CountingReader(object):
+    """File-like wrapper counting the bytes read through it"""
+    def __init__(self, fp):
+        self.fp = fp
+        self.bytes_read = 0
+
+    def read(self, *args):
+        data = self.fp.read(*args)
+        self.bytes_read += len(data)
+        return data
+
 class UrlJsonProvider(JsonProvider):
-    def __init__(self, host="localhost", port="15101", path="/debug/vars"):
+    # With server_filter set, keys are requested as ?<filter_param>=<key>&...
+    # once an unfiltered read has recorded the full size of the payload.  The
+    # first filtered response is parsed in full to find out whether the
+    # server honours the filter (filter_supported, None until then); if not,
+    # the provider goes back to unfiltered requests and streaming filtering.
+    server_filter = False
+    filter_param = 'var'
+    filter_supported = None
+    full_bytes = None
+    _filtering = False
+    # Ask for gzip or deflate compressed responses, trading CPU for bandwidth
+    compression = False
+    # With cache set to a FetchCache, payloads fetched by any provider of the
+    # same url and keys less than cache_ttl seconds ago are reused.  Tracking
+    # changes bypasses the cache, as its payloads only hold changed sections.
+    cache = None
+    cache_ttl = 0.0
+
+    def __init__(self, host="localhost", port="15101", path="/debug/vars", timeout=DEFAULT_DEADLINE):
         self.host = host
         self.port = port
         self.path = path
+        self.timeout = timeout
+
+    @classmethod
+    def from_url(cls, url):
+        parsed = urlparse.urlparse(url)
+        return cls(host=parsed.hostname, port=str(parsed.port or 80), path=parsed.path or "/debug/vars")
+
+    def url(self):
+        return "http://%s:%s%s" % (self.host, self.port, self.path)
 
     def get_json(self):
-        url = "http://%s:%s%s" % (self.host, self.port, self.path)
-        return self._fetch(url)
+        if self.cache is None or not self.cache_ttl or self.track_changes:
+            return self._fetch("http://%s:%s%s" % (self.host, self.port, self.request_path()))
+
+        start = time.time()
+        key = (self.url(), frozenset(self.keys) if self.keys is not None else None)
+        data, hit = self.cache.get(key, self._fetch_sized, self.cache_ttl, self.timeout)
+        if hit:
+            # Nothing was fetched or parsed for this read, only waited on
+            self.fetch_time = time.time() - start
+            self.parse_time = 0.0
+            self.response_bytes = 0
+            self.transfer_bytes = 0
+            self.bytes_saved = 0
+        return data
+
+    def _fetch_sized(self):
+        data = self._fetch("http://%s:%s%s" % (self.host, self.port, self.request_path()))
+        return data, self.response_bytes
+
+    def request_path(self):
+        """Returns the path to request next, asking for just keys when server side filtering is on"""
+        self._filtering = bool(self.server_filter and self.keys and self.filter_supported is not False
+                               and self.full_bytes is not None)
+        if not self._filtering:
+            return self.path
+        return "%s?%s" % (self.path, urllib.urlencode([(self.filter_param, key) for key in self.keys]))
+
+    def decode(self, fp, content_encoding):
+        """Parses a response body read from fp, decompressing it if the server compressed it"""
+        if content_encoding and content_encoding.strip().lower() in ('gzip', 'deflate'):
+            reader = DecompressingReader(fp)
+            data = self.parse(reader)
+            self.transfer_bytes = reader.bytes_read
+            return data
+        data = self.parse(fp)
+        self.transfer_bytes = self.response_bytes
+        return data
+
+    def parse(self, fp):
+        """Parses a response to the last request_path()"""
+        if not self._filtering:
+            data = self.load(fp)
+            if self.server_filter and self.response_bytes:
+                self.full_bytes = self.response_bytes
+            self.bytes_saved = 0
+            return data
+
+        if self.filter_supported is None:
+            keys = self.keys
+            self.keys = None
+            try:
+                data = self.load(fp)
+            finally:
+                self.keys = keys
+            extra = (set(data) | self.unchanged) - set(keys)
+            self.filter_supported = not extra
+            if extra:
+                logger.notice("%s ignores ?%s= filters, falling back to streaming filtering" % (self.url(), self.filter_param))
+                data = dict((key, data[key]) for key in keys if key in data)
+        else:
+            data = self.load(fp)
+        self.bytes_saved = max(0, self.full_bytes - self.response_bytes) if self.filter_supported and self.response_bytes else 0
+        return data
 
-    def _fetch(self, url, attempt=1):
+    def _fetch(self, url):
+        # A single attempt; failing targets are backed off by TargetHealth rather than retried inline
         response = None
         try:
-            logger.info('Fetching api information from: %s' % url)
-            request = urllib2.Request(url)
-            response = urllib2.urlopen(request, timeout=10)
-            logger.debug('Raw api response: %s' % response)
-            return json.load(response)
-        except (urllib2.URLError, urllib2.HTTPError), e:
-            if attempt <= MAX_ATTEMPTS:
-                logger.warning("Failed to get json data. Retrying in %ds" % SLEEP_TIME)
-                time.sleep(SLEEP_TIME)
-                return self._fetch(url, attempt + 1)
-            raise
+            logger.info('Fetching api information from: %s', url)
+            start = time.time()
+            with tracer.phase('fetch', url):
+                response = self._open(url)
+            self.fetch_time = time.time() - start
+            logger.debug('Raw api response: %s', response)
+            if self.track_changes:
+                if response.getcode() == 304:
+                    return self.not_modified()
+                self.etag = response.info().getheader('ETag')
+            with tracer.phase('parse', url):
+                return self.decode(response, response.info().getheader('Content-Encoding'))
         finally:
             if response:
                 response.close()
 
+    def _open(self, url):
+        request = urllib2.Request(url)
+        if self.track_changes and self.etag:
+            request.add_header('If-None-Match', self.etag)
+        if self.compression:
+            request.add_header('Accept-Encoding', 'gzip, deflate')
+        try:
+            return urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError, e:
+            # urllib2 treats 304 Not Modified as an error; its HTTPError doubles as the response
+            if e.code == 304:
+                return e
+            raise
+
+class PooledUrlJsonProvider(UrlJsonProvider):
+    """UrlJsonProvider reusing keep-alive connections from a HttpConnectionPool
+
+    Arguments
+        pool -- the HttpConnectionPool to use (default: the shared connection_pool)
+    """
+    def __init__(self, host="localhost", port="15101", path="/debug/vars", timeout=DEFAULT_DEADLINE, pool=None):
+        super(PooledUrlJsonProvider, self).__init__(host, port, path, timeout)
+        self.pool = pool or connection_pool
+
+    def _open(self, url):
+        headers = {}
+        if self.track_changes and self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.compression:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        parsed = urlparse.urlsplit(url)
+        path = "%s?%s" % (parsed.path, parsed.query) if parsed.query else parsed.path
+        return self.pool.urlopen(self.host, self.port, path, timeout=self.timeout, headers=headers)
+
+class AsyncUrlJsonProvider(UrlJsonProvider):
+    """UrlJsonProvider that can be fetched without blocking by an AsyncFetchPool
+
+    Requests are sent as HTTP/1.0, so the server closes the connection once
+    the whole response is sent.  get_json() still fetches synchronously.
+    """
+    _address = None
+
+    def address(self):
+        """Returns the (family, sockaddr) to connect to, resolved once until a fetch fails"""
+        if self._address is None:
+            family, _, _, _, sockaddr = socket.getaddrinfo(self.host, int(self.port), 0, socket.SOCK_STREAM)[0]
+            self._address = (family, sockaddr)
+        return self._address
+
+    def request(self):
+        headers = ""
+        if self.track_changes and self.etag:
+            headers += "If-None-Match: %s\r\n" % self.etag
+        if self.compression:
+            headers += "Accept-Encoding: gzip, deflate\r\n"
+        return ("GET %s HTTP/1.0\r\nHost: %s:%s\r\nAccept: application/json\r\n%s\r\n"
+                % (self.request_path(), self.host, self.port, headers))
+
+    def complete(self, response, fetch_time):
+        """Parses a raw HTTP response read by an AsyncFetchPool"""
+        self.fetch_time = fetch_time
+        head, _, body = response.partition("\r\n\r\n")
+        status_line = head.split("\r\n", 1)[0]
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise IOError("Malformed response from %s: %r" % (self.url(), status_line))
+        headers = {}
+        for line in head.split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if self.track_changes:
+            if parts[1] == "304":
+                return self.not_modified()
+            self.etag = headers.get("etag")
+        if parts[1] != "200":
+            raise IOError("HTTP %s from %s" % (status_line, self.url()))
+        logger.debug('Raw api response: %s', status_line)
+        with tracer.phase('parse', self.url()):
+            return self.decode(StringIO(body), headers.get("content-encoding"))
+
+    def failed(self):
+        # Resolve again in case the target moved
+        self._address = None
+
 class FileJsonProvider(JsonProvider):
     def __init__(self, path):
         self.path = path
 
     def get_json(self):
         with open(self.path, "r") as f:
-            return json.load(f)
+            with tracer.phase('parse', self.path):
+                return self.load(f)
 
 class MetricEmitter(object):
-    def __init__(self, collectd, plugin_instance, plugin='vitess'):
+    """Dispatches metrics to collectd
+
+    The collectd.Values for each series, with its plugin, plugin_instance,
+    type and type_instance already filled in, is cached by metric name,
+    type and tags, so later intervals only have to set the value and
+    dispatch.  Tags are rendered sorted by name so a series always gets the
+    same type_instance.
+
+    With batch set, values are buffered instead of dispatched right away and
+    flush() dispatches everything buffered in a single pass.  Each value is
+    still dispatched on its own, as collectd.Values holds a single series.
+
+    With heartbeat set, a value equal to the last one dispatched for its
+    series is suppressed, unless heartbeat seconds have passed since then,
+    so downstream staleness detection still sees the series.
+
+    With rates or deltas set, the last value and timestamp of every counter
+    series is kept alongside its cached collectd.Values, and each new value
+    also emits <name>.rate (per second) and/or <name>.delta gauges from the
+    second sample on.  A counter going backwards is taken as a restart from
+    zero and counted in counter_resets.  raw_counters=False then drops the
+    counters themselves.  Samples are timed with timestamp when it is set,
+    i.e. by the collector at the start of each read, and the current time
+    otherwise.
+
+    Once more than max_identities series are cached, begin_read() evicts
+    those not seen for IDENTITY_EXPIRY_READS reads, and then, if still over,
+    all but those seen on the last read.  Series seen on the last read are
+    always kept, so the cache grows to fit a target's live series and their
+    state carries over between reads.
+
+    Arguments
+        collectd -- the collectd object to use
+        plugin_instance -- plugin_instance to report metrics under
+        plugin -- name of the plugin (default 'vitess')
+        max_identities -- series cached before stale ones are evicted (default IDENTITY_CACHE_SIZE)
+        batch -- buffer values until flush() is called (default False)
+        heartbeat -- suppress unchanged values for this many seconds (default None, never suppress)
+        rates -- emit the per second rate of counters (default False)
+        deltas -- emit the per interval increase of counters (default False)
+        raw_counters -- emit counters themselves (default True)
+    """
+    def __init__(self, collectd, plugin_instance, plugin='vitess', max_identities=IDENTITY_CACHE_SIZE, batch=False, heartbeat=None,
+                 rates=False, deltas=False, raw_counters=True):
         self.collectd = collectd
         self.plugin_instance = plugin_instance
         self.plugin = plugin
+        self.max_identities = max_identities
+        self.batch = batch
+        self.heartbeat = heartbeat
+        self.rates = rates
+        self.deltas = deltas
+        self.raw_counters = raw_counters
+        self.timestamp = None
+        self.emitted = 0
+        self.suppressed = 0
+        self.counter_resets = 0
+        self.reads = 0
+        self._series = {}
+        self._rendered = {}
+        self._buffer = []
+        self._recording = None
 
     def emit(self, metric_name, metric_value, type, tags=None):
-        method_name = "emit_metric for " + metric_name
-        entry(method_name)
-        self._emit(metric_name, metric_value, type, tags)
-        leave(method_name)
+        if self._recording is not None:
+            self._recording.append((metric_name, [metric_value], type, tags))
+        if tracer.enabled:
+            entry("emit_metric for %s", metric_name)
+            self._emit(metric_name, [metric_value], type, tags)
+            leave("emit_metric for %s", metric_name)
+        else:
+            self._emit(metric_name, [metric_value], type, tags)
+
+    def emit_multi(self, metric_name, metric_values, type, tags=None):
+        """Emits several values as a single series of a multi-value type
 
-    def _emit(self, metric_name, metric_value, type, tags):
-        tag_str = self._generate_tags_str(tags)
+        type must be defined in collectd's types.db with as many data sources
+        as there are values.
+        """
+        if self._recording is not None:
+            self._recording.append((metric_name, list(metric_values), type, tags))
+        self._emit(metric_name, list(metric_values), type, tags)
+
+    def emit_volatile(self, metric_name, metric_value, type, tags=None):
+        """Emits a value that only holds for this read, so it is never recorded"""
+        self._emit(metric_name, [metric_value], type, tags)
+
+    def record(self):
+        """Starts recording emitted values, so they can be replayed later"""
+        self._recording = []
+
+    def stop_recording(self):
+        """Returns what was emitted since record()"""
+        recorded = self._recording
+        self._recording = None
+        return recorded
+
+    def replay(self, recorded):
+        """Emits values recorded on an earlier read again"""
+        for metric_name, metric_values, type, tags in recorded:
+            self._emit(metric_name, metric_values, type, tags)
+
+    def begin_read(self):
+        """Starts a read of the target, evicting stale series when over max_identities"""
+        self.reads += 1
+        self._series = self._evict(self._series)
+        self._rendered = self._evict(self._rendered)
+
+    def _evict(self, cache):
+        if len(cache) <= self.max_identities:
+            return cache
+        oldest = self.reads - IDENTITY_EXPIRY_READS
+        cache = dict((key, series) for key, series in cache.iteritems() if series.seen >= oldest)
+        if len(cache) > self.max_identities:
+            last = self.reads - 1
+            cache = dict((key, series) for key, series in cache.iteritems() if series.seen >= last)
+        return cache
+
+    def flush(self):
+        """Dispatches all buffered values and returns how many there were"""
+        buffered = self._buffer
+        self._buffer = []
+        for val, values in buffered:
+            val.values = values
+            val.dispatch()
+        return len(buffered)
+
+    def _emit(self, metric_name, metric_values, type, tags):
+        key = (metric_name, type, frozenset(tags.iteritems()) if tags else None)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = _Series(self._create_values(metric_name, type, tags))
+        series.seen = self.reads
+
+        if type == 'counter' and (self.rates or self.deltas or not self.raw_counters):
+            if not self._derive(metric_name, metric_values, tags, series):
+                return
+
+        if self.heartbeat is not None:
+            now = time.time()
+            if metric_values == series.last_values and now - series.last_sent < self.heartbeat:
+                self.suppressed += 1
+                return
+            series.last_values = metric_values
+            series.last_sent = now
+
+        val = series.values
+        self.emitted += 1
+        if self.batch:
+            self._buffer.append((val, metric_values))
+        else:
+            val.values = metric_values
+            val.dispatch()
+
+    def _derive(self, metric_name, metric_values, tags, series):
+        """Emits the rate and delta of a counter series, returns whether to emit the counter itself"""
+        if len(metric_values) != 1:
+            return True
+        value = metric_values[0]
+        now = self.timestamp or time.time()
+        last, last_time = series.last_counter, series.last_time
+        series.last_counter = value
+        series.last_time = now
+        if last is not None and now > last_time:
+            delta = value - last
+            if delta < 0:
+                self.counter_resets += 1
+                delta = value
+            if self.deltas:
+                self._emit(metric_name + '.delta', [delta], 'gauge', tags)
+            if self.rates:
+                self._emit(metric_name + '.rate', [delta / float(now - last_time)], 'gauge', tags)
+        return self.raw_counters
+
+    def dispatch_rendered(self, type_instance, type, metric_values):
+        """Dispatches values whose type_instance was already rendered, i.e. by a worker process"""
+        key = (type_instance, type)
+        series = self._rendered.get(key)
+        if series is None:
+            val = self.collectd.Values(plugin=self.plugin, plugin_instance=self.plugin_instance)
+            val.type = type
+            val.type_instance = type_instance
+            series = self._rendered[key] = _Series(val)
+        series.seen = self.reads
+        val = series.values
+        if self.batch:
+            self._buffer.append((val, metric_values))
+        else:
+            val.values = metric_values
+            val.dispatch()
+
+    def _create_values(self, metric_name, type, tags):
         val = self.collectd.Values(plugin=self.plugin, plugin_instance=self.plugin_instance)
         val.type = type
-        val.type_instance = "%s.%s.%s%s" % (self.plugin, self.plugin_instance, metric_name, tag_str)
-        val.values = [metric_value]
-        val.dispatch()
+        val.type_instance = self.type_instance(metric_name, tags)
+        return val
+
+    def type_instance(self, metric_name, tags):
+        return "%s.%s.%s%s" % (self.plugin, self.plugin_instance, metric_name, self._generate_tags_str(tags))
 
     def _generate_tags_str(self, tags):
         if tags:
-            return "[%s]" % ','.join(["%s=%s" % (x, y) for x, y in tags.items()])
+            return "[%s]" % ','.join(["%s=%s" % (x, y) for x, y in sorted(tags.iteritems())])
         return ""
 
+class _Series(object):
+    """State kept by MetricEmitter for each series it has seen"""
+    __slots__ = ('values', 'last_values', 'last_sent', 'last_counter', 'last_time', 'seen')
+
+    def __init__(self, values):
+        self.values = values
+        self.last_values = None
+        self.last_sent = 0
+        self.last_counter = None
+        self.last_time = 0
+        # MetricEmitter.reads when the series was last emitted
+        self.seen = 0
+
+class TargetHealth(object):
+    """Per-target health state machine
+
+    A target starts HEALTHY.  Each failed fetch moves it to FAILING and
+    schedules the next attempt using exponential backoff with jitter, so a
+    down tablet is skipped on later intervals instead of holding a read
+    thread while it is retried.  The first successful fetch moves it back
+    to HEALTHY.
+
+    Arguments
+        base_delay -- backoff (seconds) after the first failure
+        max_delay -- upper bound (seconds) on the backoff
+    """
+    HEALTHY = 'healthy'
+    FAILING = 'failing'
+
+    def __init__(self, base_delay=BACKOFF_BASE, max_delay=BACKOFF_MAX):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = TargetHealth.HEALTHY
+        self.failures = 0
+        self.next_attempt = 0
+
+    def should_fetch(self, now):
+        return now >= self.next_attempt
+
+    def record_success(self):
+        self.state = TargetHealth.HEALTHY
+        self.failures = 0
+        self.next_attempt = 0
+
+    def record_failure(self, now):
+        """Records a failed fetch and returns the delay until the next attempt"""
+        self.state = TargetHealth.FAILING
+        self.failures += 1
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1))
+        # "Equal jitter": keep at least half the backoff so retries stay spread out
+        delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        self.next_attempt = now + delay
+        return delay
+
+class CardinalityLimiter(object):
+    """Keeps the top-K series of a tagged metric, folding the rest into 'other'
+
+    Series are ranked by an exponentially decayed score of their rate (the
+    per interval increase of counters, the value of gauges), tracked for at
+    most capacity series like a space-saving heavy hitters summary: the
+    lowest scoring series are forgotten first.  A series only loses its
+    place in the top-K once a series outside it scores LIMITER_HYSTERESIS
+    times higher, so the set of reported series stays stable across
+    intervals while a new heavy hitter still gets in.
+
+    Everything outside the top-K is reported as a single series with every
+    tag set to OTHER_TAG_VALUE.  For counters it accumulates the increases
+    of the folded series, so it stays monotonic as series move in and out
+    of the top-K.
+
+    Arguments
+        limit -- number of series to keep (K)
+        capacity -- number of series to track scores for (default 4 * limit)
+        decay -- factor scores are multiplied by every interval (default LIMITER_DECAY)
+    """
+    def __init__(self, limit, capacity=None, decay=LIMITER_DECAY):
+        self.limit = limit
+        self.capacity = capacity or limit * 4
+        self.decay = decay
+        self.folded = 0
+        self._scores = {}
+        self._last = {}
+        self._members = set()
+        self._other_total = 0
+        self._folding = False
+
+    def select(self, tagged_values, type, tag_list):
+        """Returns the (tags, value) pairs to report out of tagged_values"""
+        counter = type == 'counter'
+        last = self._last
+        current = {}
+        entries = []
+        for tags, value in tagged_values:
+            key = frozenset(tags.iteritems())
+            if counter:
+                prev = last.get(key)
+                rate = value - prev if prev is not None and value >= prev else 0
+            else:
+                rate = abs(value)
+            current[key] = value
+            entries.append((key, tags, value, rate))
+        self._last = current
+
+        self._update_scores(entries)
+        if len(entries) <= self.limit and not self._folding:
+            self._members = set(current)
+            self.folded = 0
+            return tagged_values
+
+        self._folding = True
+        self._members = members = self._select_members(current)
+        result = []
+        other = 0
+        for key, tags, value, rate in entries:
+            if key in members:
+                result.append((tags, value))
+            else:
+                other += rate if counter else value
+        self.folded = len(entries) - len(result)
+        if counter:
+            self._other_total += other
+            other = self._other_total
+        result.append((dict((tag, OTHER_TAG_VALUE) for tag in tag_list), other))
+        return result
+
+    def _update_scores(self, entries):
+        scores = self._scores
+        decay = self.decay
+        for key in scores:
+            scores[key] *= decay
+        for key, tags, value, rate in entries:
+            if rate > 0 or key in scores:
+                scores[key] = scores.get(key, 0) + rate
+        if len(scores) > self.capacity:
+            self._scores = dict(heapq.nlargest(self.capacity, scores.iteritems(), key=operator.itemgetter(1)))
+
+    def _select_members(self, current):
+        scores = self._scores
+        members = set(k for k in self._members if k in current)
+        # The best series outside the top-K, weakest first
+        challengers = heapq.nlargest(self.limit, [(k, v) for k, v in scores.iteritems() if k in current and k not in members],
+                                     key=operator.itemgetter(1))
+        challengers.reverse()
+        while challengers and len(members) < self.limit:
+            members.add(challengers.pop()[0])
+        # Replace the weakest members as long as the best challenger outscores them LIMITER_HYSTERESIS times
+        for member in sorted(members, key=lambda k: scores.get(k, 0)):
+            if not challengers or challengers[-1][1] <= scores.get(member, 0) * LIMITER_HYSTERESIS:
+                break
+            members.remove(member)
+            members.add(challengers.pop()[0])
+        if len(members) < self.limit:
+            # Not enough active series yet, fill up with idle ones in a stable order
+            for key in sorted(set(current) - members, key=sorted):
+                if len(members) >= self.limit:
+                    break
+                members.add(key)
+        return members
+
+class HistogramLayout(object):
+    """Bucket layout of a vitess timing histogram, converted once
+
+    Vitess reports a histogram as cumulative counts keyed by the bucket's
+    upper bound in ns, followed by "inf", "Count" and "Time".  The layout
+    holds the keys in bucket order, their labels converted to ms, and the
+    metric names derived from them per base name.
+
+    Arguments
+        keys -- the keys of a histogram with this layout
+    """
+    __slots__ = ('keys', 'labels', 'bounds', 'buckets', 'time_index', '_names')
+
+    def __init__(self, keys):
+        finite = sorted([key for key in keys if key.isdigit()], key=long)
+        buckets = finite + [key for key in keys if key == 'inf']
+        self.keys = tuple(buckets + sorted([key for key in keys if key not in buckets]))
+        self.labels = tuple(["%d" % nsToMs(long(key)) for key in finite] + list(self.keys[len(finite):]))
+        self.bounds = tuple([nsToMs(long(key)) for key in finite])
+        self.buckets = len(buckets)
+        self.time_index = self.keys.index('Time') if 'Time' in self.keys else None
+        self._names = {}
+
+    def names(self, base):
+        """Returns the metric names of each key for the histogram named base"""
+        names = self._names.get(base)
+        if names is None:
+            names = self._names[base] = tuple(["%sHistogram.%s" % (base, label) for label in self.labels])
+        return names
+
+class HistogramEngine(object):
+    """Emits vitess timing histograms as raw buckets and/or percentiles
+
+    Layouts are cached by key set, so bucket boundaries are only converted
+    the first time a layout is seen.  Percentiles are interpolated linearly
+    within the cumulative bucket they fall into, over the observations made
+    since the previous read of the same series when state is given (and
+    over the process' lifetime on the first read or after a restart).
+    Those falling into the "inf" bucket are reported as the largest finite
+    bound.
+
+    Arguments
+        percentiles -- percentiles to derive, i.e. [50, 95, 99]
+    """
+    def __init__(self, percentiles=()):
+        self.percentiles = percentiles
+        self._layouts = {}
+
+    @property
+    def percentiles(self):
+        return self._percentiles
+
+    @percentiles.setter
+    def percentiles(self, percentiles):
+        self._percentiles = tuple((q / 100.0, "P%s" % ("%g" % q).replace('.', '_')) for q in percentiles)
+
+    def layout(self, histogram):
+        keys = frozenset(histogram)
+        layout = self._layouts.get(keys)
+        if layout is None:
+            layout = self._layouts[keys] = HistogramLayout(keys)
+        return layout
+
+    def emit(self, emitter, base, histogram, tags=None, include_buckets=True, state=None):
+        """Emits histogram under the name base, i.e. 'MysqlExecTime'
+
+        Arguments
+            emitter -- the MetricEmitter to report values through
+            base -- base name of the histogram's metrics
+            histogram -- a single histogram from the json data
+            tags -- tags of the histogram's series, if any
+            include_buckets -- whether to emit every raw bucket
+            state -- dict keeping counts between reads for interval percentiles
+        """
+        layout = self.layout(histogram)
+        values = [histogram[key] for key in layout.keys]
+        if include_buckets:
+            emit = emitter.emit
+            time_index = layout.time_index
+            for i, name in enumerate(layout.names(base)):
+                emit(name, nsToMs(values[i]) if i == time_index else values[i], 'gauge', tags)
+
+        if not self._percentiles or not layout.buckets:
+            return
+        counts = values[:layout.buckets]
+        if state is not None:
+            key = (base, frozenset(tags.iteritems()) if tags else None)
+            previous = state.get(key)
+            state[key] = counts
+            if previous is not None and len(previous) == len(counts) and all(c >= p for c, p in zip(counts, previous)):
+                counts = [c - p for c, p in zip(counts, previous)]
+        total = counts[-1]
+        if total <= 0:
+            return
+        for quantile, suffix in self._percentiles:
+            emitter.emit_volatile(base + suffix, self._percentile(layout.bounds, counts, quantile * total), 'gauge', tags)
+
+    def _percentile(self, bounds, counts, rank):
+        lower = 0.0
+        below = 0
+        for i, upper in enumerate(bounds):
+            count = counts[i]
+            if count >= rank:
+                if count == below:
+                    return upper
+                return lower + (upper - lower) * (rank - below) / float(count - below)
+            lower = upper
+            below = count
+        return lower
+
+class PlanStep(object):
+    """A compiled entry of a collector's metric catalogue
+
+    Arguments
+        kind -- kind of the spec entry, i.e. 'metric' or 'timing'
+        name -- name of the metric in /debug/vars
+        section -- top level /debug/vars key the step reads
+        run -- callable taking the json data and emitting the step's values
+        tier -- priority tier, TIER_CORE steps always run (default TIER_CORE)
+        every -- the step runs on every this many reads of a target (default 1)
+    """
+    __slots__ = ('kind', 'name', 'section', 'run', 'tier', 'every')
+
+    def __init__(self, kind, name, section, run, tier=TIER_CORE, every=1):
+        self.kind = kind
+        self.name = name
+        self.section = section
+        self.run = run
+        self.tier = tier
+        self.every = every
+
+def load_metric_spec(path):
+    """Loads a list of metric spec entries from a json file"""
+    with open(path, "r") as f:
+        spec = json.load(f)
+    if not isinstance(spec, list) or not all(isinstance(entry, dict) and 'name' in entry for entry in spec):
+        raise ValueError("%s must contain a list of metric specs, each with a name" % path)
+    return spec
+
+def merge_metric_spec(spec, overrides):
+    """Applies overrides to spec
+
+    Override entries with "drop": true remove every entry of that name,
+    and all others are appended.
+    """
+    dropped = set(entry['name'] for entry in overrides if entry.get('drop'))
+    merged = [entry for entry in spec if entry['name'] not in dropped]
+    merged.extend([entry for entry in overrides if not entry.get('drop')])
+    return merged
+
+class TargetStats(object):
+    """Measurements of a target's last read, reported as self metrics
+
+    Times are in seconds.  fetch_errors, skipped_fetches and deferred_steps
+    are cumulative.
+    """
+    def __init__(self):
+        self.reset()
+        self.fetch_errors = 0
+        self.skipped_fetches = 0
+        self.deferred_steps = 0
+
+    # Fields describing the last read, as opposed to the cumulative ones
+    PER_READ = ('fetch_time', 'parse_time', 'response_bytes', 'process_time', 'values_emitted',
+                'values_suppressed', 'counter_resets', 'series_folded', 'key_errors', 'sections_reused',
+                'bytes_saved', 'transfer_bytes', 'steps_deferred')
+
+    def update(self, other):
+        """Copies the last read's fields from other, i.e. stats sent back by a worker process"""
+        for field in self.PER_READ:
+            setattr(self, field, getattr(other, field))
+        self.deferred_steps += other.steps_deferred
+
+    def reset(self):
+        self.fetch_time = 0.0
+        self.parse_time = 0.0
+        self.response_bytes = 0
+        self.process_time = 0.0
+        self.values_emitted = 0
+        self.values_suppressed = 0
+        self.counter_resets = 0
+        self.series_folded = 0
+        self.key_errors = 0
+        self.sections_reused = 0
+        self.bytes_saved = 0
+        self.transfer_bytes = 0
+        self.steps_deferred = 0
+
+class Target(object):
+    """A single endpoint scraped by a collector
+
+    Each target has its own json provider and emitter, so that its metrics
+    are reported under their own plugin_instance.
+
+    Arguments
+        name -- plugin_instance to report this target's metrics under
+        json_provider -- the JsonProvider to fetch data from
+        emitter -- the MetricEmitter to report metrics through
+    """
+    def __init__(self, name, json_provider, emitter):
+        self.name = name
+        self.json_provider = json_provider
+        self.emitter = emitter
+        self.health = TargetHealth()
+        self.stats = TargetStats()
+        self.limiters = {}
+        self.histograms = {}
+        self.recorded = {}
+        # Plan steps deferred by the last read, mapped to the read they were first deferred on
+        self.deferred = {}
+        self.reads = 0
+        self.in_flight = False
+
+class FetchPool(object):
+    """Bounded pool of daemon threads fetching json for many targets
+
+    Results are put on the queue passed to submit() as (target, data, error)
+    tuples as soon as each fetch completes, so a slow target never holds up
+    the others.
+
+    Arguments
+        size -- maximum number of concurrent fetches
+    """
+    def __init__(self, size=DEFAULT_FETCH_THREADS):
+        self.size = size
+        self._jobs = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, target, results):
+        self._start()
+        target.in_flight = True
+        self._jobs.put((target, results))
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work, name="vitess-fetch-%d" % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            target, results = self._jobs.get()
+            data, error = None, None
+            try:
+                data = target.json_provider.get_json()
+            except Exception as e:
+                error = e
+            target.in_flight = False
+            results.put((target, data, error))
+
+class _AsyncFetch(object):
+    """A single non-blocking fetch driven by AsyncFetchPool"""
+    __slots__ = ('target', 'results', 'sock', 'out', 'chunks', 'connected', 'start', 'deadline')
+
+    def __init__(self, target, results, now):
+        provider = target.json_provider
+        self.target = target
+        self.results = results
+        self.start = now
+        self.deadline = now + provider.timeout
+        self.out = provider.request()
+        self.chunks = []
+        logger.info('Fetching api information from: %s', provider.url())
+        family, sockaddr = provider.address()
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.sock.close()
+            raise socket.error(err, os.strerror(err))
+        self.connected = err == 0
+
+    def writable(self):
+        return bool(self.out)
+
+    def handle_write(self):
+        if not self.connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self.connected = True
+        sent = self.sock.send(self.out)
+        self.out = self.out[sent:]
+
+    def handle_read(self):
+        """Reads what is available, returns True once the server has closed the connection"""
+        data = self.sock.recv(jsonstream.CHUNK_SIZE)
+        if not data:
+            return True
+        self.chunks.append(data)
+        return False
+
+class AsyncFetchPool(object):
+    """Fetches json for many targets on a single event loop thread
+
+    A drop-in replacement for FetchPool for AsyncUrlJsonProviders: every
+    fetch is a non-blocking socket multiplexed with select() on one daemon
+    thread, so hundreds of targets don't need hundreds of threads.  At most
+    size fetches are in flight at once, each is failed with socket.timeout
+    once its provider's timeout has passed, and with stagger set each target
+    is started at a fixed offset within stagger seconds of being submitted
+    (derived from its name), so scrapes don't hit a fleet all at once.
+    Results are put on the queue passed to submit() as (target, data, error)
+    tuples, as with FetchPool.  Other providers are fetched synchronously on
+    the loop thread.
+
+    Arguments
+        size -- maximum number of concurrent fetches
+        stagger -- seconds over which to spread the start of fetches (default 0)
+    """
+    def __init__(self, size=DEFAULT_FETCH_THREADS, stagger=0.0):
+        self.size = size
+        self.stagger = stagger
+        self._jobs = Queue.Queue()
+        self._waiting = []
+        self._active = {}
+        self._seq = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+
+    def submit(self, target, results):
+        self._start()
+        target.in_flight = True
+        self._jobs.put((target, results))
+        os.write(self._wake_w, 'x')
+
+    def offset(self, target):
+        """Returns how long after being submitted target is fetched"""
+        if not self.stagger:
+            return 0.0
+        return (zlib.crc32(target.name) & 0xffffffff) % 1000 / 1000.0 * self.stagger
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="vitess-fetch-loop")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            now = time.time()
+            self._accept(now)
+            while self._waiting and self._waiting[0][0] <= now and len(self._active) < self.size:
+                _, _, target, results = heapq.heappop(self._waiting)
+                self._begin(target, results, now)
+
+            readable = [self._wake_r] + [fd for fd, fetch in self._active.iteritems() if not fetch.writable()]
+            writable = [fd for fd, fetch in self._active.iteritems() if fetch.writable()]
+            try:
+                readable, writable, _ = select.select(readable, writable, [], self._timeout(now))
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in writable:
+                self._step(fd, lambda fetch: fetch.handle_write())
+            for fd in readable:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    continue
+                self._step(fd, self._read)
+
+            now = time.time()
+            for fd, fetch in self._active.items():
+                if now >= fetch.deadline:
+                    self._finish(fd, error=socket.timeout("timed out after %.1fs" % (now - fetch.start)))
+
+    def _accept(self, now):
+        while True:
+            try:
+                target, results = self._jobs.get_nowait()
+            except Queue.Empty:
+                return
+            self._seq += 1
+            heapq.heappush(self._waiting, (now + self.offset(target), self._seq, target, results))
+
+    def _timeout(self, now):
+        deadlines = [fetch.deadline for fetch in self._active.itervalues()]
+        if self._waiting and len(self._active) < self.size:
+            deadlines.append(self._waiting[0][0])
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    def _begin(self, target, results, now):
+        if not isinstance(target.json_provider, AsyncUrlJsonProvider):
+            data, error = None, None
+            try:
+                data = target.json_provider.get_json()
+            except Exception as e:
+                error = e
+            target.in_flight = False
+            results.put((target, data, error))
+            return
+        try:
+            fetch = _AsyncFetch(target, results, now)
+        except Exception as e:
+            target.json_provider.failed()
+            target.in_flight = False
+            results.put((target, None, e))
+            return
+        self._active[fetch.sock.fileno()] = fetch
+
+    def _step(self, fd, handler):
+        fetch = self._active.get(fd)
+        if fetch is None:
+            return
+        try:
+            handler(fetch)
+        except Exception as e:
+            self._finish(fd, error=e)
+
+    def _read(self, fetch):
+        if fetch.handle_read():
+            self._finish(fetch.sock.fileno())
+
+    def _finish(self, fd, error=None):
+        fetch = self._active.pop(fd)
+        fetch.sock.close()
+        target = fetch.target
+        data = None
+        if error is None:
+            try:
+                data = target.json_provider.complete(''.join(fetch.chunks), time.time() - fetch.start)
+            except Exception as e:
+                error = e
+        if error is not None:
+            target.json_provider.failed()
+        target.in_flight = False
+        fetch.results.put((target, data, error))
+
+class RenderedRead(object):
+    """What a worker process sends back for one read of a target
+
+    Arguments
+        values -- list of (type_instance, type, values) tuples to dispatch
+        stats -- the target's TargetStats for the read
+    """
+    def __init__(self, values, stats):
+        self.values = values
+        self.stats = stats
+
+class _RecordingCollectd(object):
+    """Stands in for collectd in worker processes, recording what would be dispatched"""
+    def __init__(self):
+        self.dispatched = []
+
+    def Values(self, plugin=None, plugin_instance=None):
+        return _RecordedValues(self)
+
+    def drain(self):
+        dispatched = self.dispatched
+        self.dispatched = []
+        return dispatched
+
+class _RecordedValues(object):
+    # Emitters cache these across reads, so they look up the recorder's current list on every dispatch
+    __slots__ = ('_recorder', 'type', 'type_instance', 'values')
+
+    def __init__(self, recorder):
+        self._recorder = recorder
+        self.type = None
+        self.type_instance = None
+        self.values = None
+
+    def dispatch(self):
+        self._recorder.dispatched.append((self.type_instance, self.type, self.values))
+
+def _worker_main(collector, conn):
+    # Runs in a forked copy of the configured collector; targets keep their state between reads
+    recorder = _RecordingCollectd()
+    for target in collector.targets:
+        target.emitter.collectd = recorder
+    while True:
+        try:
+            key, budget_deadline = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if budget_deadline == _FORGET:
+            collector.discovered_targets.pop(key, None)
+            continue
+        try:
+            target = _worker_target(collector, key, recorder)
+            json_data = target.json_provider.get_json()
+            collector.process_target(target, json_data, budget_deadline)
+            target.emitter.flush()
+            conn.send((RenderedRead(recorder.drain(), target.stats), None))
+        except Exception as e:
+            recorder.drain()
+            conn.send((None, "%s: %s" % (type(e).__name__, e)))
+
+def _worker_target(collector, key, recorder):
+    # Configured targets are known by their index, discovered ones by url and created on their first read
+    if not isinstance(key, basestring):
+        return collector.targets[key]
+    target = collector.discovered_targets.get(key)
+    if target is None:
+        provider = collector.provider_cls.from_url(key)
+        provider.timeout = collector.fetch_timeout()
+        target = collector.discovered_targets[key] = collector.create_target(provider, True)
+        target.emitter.collectd = recorder
+    return target
+
+# Sent to a worker in place of a budget deadline to have it drop a discovered target
+_FORGET = 'forget'
+
+class ProcessPool(object):
+    """Fetches, parses and processes targets in worker processes
+
+    Parsing large payloads holds the GIL for a long time, stalling every
+    other python plugin loaded into collectd.  start() forks size copies of
+    the configured collector, and each target is pinned to one of them so
+    its state (cardinality limiters, histograms, counters) carries over
+    between reads.  Workers send back the read as a RenderedRead, which
+    the collector only has to dispatch.  Targets discovered after start()
+    are pinned to a worker by url, which creates its own copy of the target
+    on the first read and drops it again on forget().  Other targets added
+    after start() are fetched in-process through fallback.
+
+    Results are put on the queue passed to submit() as (target, data, error)
+    tuples, as with FetchPool.
+
+    Arguments
+        size -- number of worker processes
+        fallback -- pool to fetch unknown targets with (default: a new FetchPool)
+    """
+    def __init__(self, size, fallback=None):
+        self.size = size
+        self.fallback = fallback or FetchPool()
+        self._workers = []
+        self._index = {}
+        self._collector = None
+
+    def start(self, collector):
+        """Forks the workers; must be called before any thread is started"""
+        self._collector = collector
+        self._index = dict((id(target), i) for i, target in enumerate(collector.targets))
+        for i in range(self.size):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker_main, args=(collector, child_conn), name="vitess-worker-%d" % i)
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            jobs = Queue.Queue()
+            thread = threading.Thread(target=self._relay, args=(conn, jobs), name="vitess-worker-relay-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self._workers.append((process, jobs))
+
+    def submit(self, target, results):
+        key = self._key(target)
+        if key is None or not self._workers:
+            self.fallback.submit(target, results)
+            return
+        target.in_flight = True
+        self._jobs(key).put((key, target, results))
+
+    def forget(self, url):
+        """Has the worker of the discovered target at url drop it"""
+        if self._workers:
+            self._jobs(url).put((url, None, None))
+
+    def _key(self, target):
+        key = self._index.get(id(target))
+        if key is None and self._collector is not None:
+            url = target.json_provider.url() if isinstance(target.json_provider, UrlJsonProvider) else None
+            if url is not None and self._collector.discovered_targets.get(url) is target:
+                return url
+        return key
+
+    def _jobs(self, key):
+        index = hash(key) if isinstance(key, basestring) else key
+        return self._workers[index % len(self._workers)][1]
+
+    def _relay(self, conn, jobs):
+        while True:
+            key, target, results = jobs.get()
+            if target is None:
+                try:
+                    conn.send((key, _FORGET))
+                except (IOError, OSError):
+                    pass
+                continue
+            rendered, error = None, None
+            try:
+                # Workers share the budget of the collector's current read
+                conn.send((key, self._collector.budget_deadline))
+                rendered, error = conn.recv()
+            except (EOFError, IOError, OSError) as e:
+                error = "Worker process exited: %s" % e
+            target.in_flight = False
+            results.put((target, rendered, IOError(error) if error else None))
+
+class TargetDiscovery(object):
+    """Keeps the list of urls to poll up to date in the background
+
+    The source is a vtctld style http endpoint or a local json file holding
+    a list of tablets, refreshed every interval seconds on a daemon thread.
+    Readers only ever look at urls, the frozenset found by the last
+    successful refresh (None until then), so discovery never adds latency
+    to a read.  A failed refresh keeps the previous urls.
+
+    Each entry of the list may be
+        - a url, or a "host:port" string
+        - an object with a "url", or a "host" and "port"
+        - a vtctld tablet record, with a "hostname" and a "port_map"
+        - a vtctld tablet alias ({"cell": ..., "uid": ...}), whose record
+          is fetched from <source>/<cell>-<uid> the first time it is seen
+          and cached for as long as the alias is listed
+
+    Arguments
+        source -- url or path of the tablet list, i.e. http://vtctld:15000/api/tablets/?cell=zone1
+        interval -- seconds between refreshes (default DEFAULT_DISCOVERY_INTERVAL)
+        port_name -- port_map entry serving /debug/vars (default 'vt')
+        path -- path of /debug/vars on each target (default '/debug/vars')
+        timeout -- seconds to wait on the source (default DEFAULT_DEADLINE)
+    """
+    def __init__(self, source, interval=DEFAULT_DISCOVERY_INTERVAL, port_name='vt', path='/debug/vars', timeout=DEFAULT_DEADLINE):
+        self.source = source
+        self.interval = interval
+        self.port_name = port_name
+        self.path = path
+        self.timeout = timeout
+        self.urls = None
+        self._records = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="vitess-discovery")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        # Callers may have refreshed once already before starting
+        if self.urls is not None:
+            time.sleep(self.interval)
+        while True:
+            self.refresh()
+            time.sleep(self.interval)
+
+    def refresh(self):
+        """Refreshes urls from the source, returns whether it succeeded"""
+        try:
+            urls = frozenset(self.discover())
+        except Exception as e:
+            logger.error("Failed to discover targets from %s: %s" % (self.source, e))
+            return False
+        if urls != self.urls:
+            logger.notice("Discovered %d targets from %s" % (len(urls), self.source))
+            self.urls = urls
+        return True
+
+    def discover(self):
+        """Returns the urls listed by the source"""
+        entries = self._load(self.source)
+        if not isinstance(entries, list):
+            raise ValueError("expected a list of tablets, got %s" % type(entries).__name__)
+        aliases = set()
+        urls = []
+        for entry in entries:
+            if isinstance(entry, dict) and 'cell' in entry and 'uid' in entry and 'hostname' not in entry:
+                alias = "%s-%s" % (entry['cell'], entry['uid'])
+                aliases.add(alias)
+                entry = self._record(alias)
+            urls.append(self._url(entry))
+        # Forget tablets that are no longer listed
+        for alias in set(self._records) - aliases:
+            del self._records[alias]
+        return urls
+
+    def _record(self, alias):
+        record = self._records.get(alias)
+        if record is None:
+            parsed = urlparse.urlparse(self.source)
+            record = self._records[alias] = self._load("%s://%s%s/%s" % (parsed.scheme, parsed.netloc, parsed.path.rstrip('/'), alias))
+        return record
+
+    def _url(self, entry):
+        if isinstance(entry, basestring):
+            if entry.startswith("http://") or entry.startswith("https://"):
+                return entry
+            return "http://%s%s" % (entry, self.path)
+        if 'url' in entry:
+            return entry['url']
+        if 'hostname' in entry:
+            return "http://%s:%s%s" % (entry['hostname'], entry['port_map'][self.port_name], self.path)
+        return "http://%s:%s%s" % (entry['host'], entry['port'], self.path)
+
+    def _load(self, source):
+        if source.startswith("http://") or source.startswith("https://"):
+            response = urllib2.urlopen(urllib2.Request(source), timeout=self.timeout)
+            try:
+                return json.load(response)
+            finally:
+                response.close()
+        with open(source, "r") as f:
+            return json.load(f)
+
 class BaseCollector(object):
+    """Base of the vitess collectors
+
+    Subclasses describe what to collect in metrics, a list of spec entries
+    (dicts) compiled into a flat extraction plan once configuration is
+    complete.  Entries have these keys:
+
+        name -- name of the metric in /debug/vars
+        kind -- 'metric' (default), 'timing', 'histogram' or 'custom'
+        type -- collectd type of a metric, i.e. 'counter' or 'gauge'
+        tags -- tag names to parse the metric's keys into
+        source -- top level key the metric is nested under, i.e. 'memstats'
+        prefix, alt_name -- the reported name is prefix + (alt_name or name)
+        transformer -- name of a function in TRANSFORMERS to apply to values
+        flag -- attribute of the collector that must be true to collect it
+        tier -- priority tier, defaults to TIER_DETAIL for flagged entries and
+                histograms, TIER_TIMINGS for timings and TIER_CORE otherwise
+        group -- schedule group, whose GroupInterval sets how many reads apart
+                 it is collected (defaults to the name)
+        method, args -- for 'custom' entries, called as method(json_data, name, *args)
+
+    MetricSpecFile adds entries from a json file of the same format, and
+    removes existing ones given as {"name": ..., "drop": true}.
+    """
+    # Catalogue of the metrics to collect, see above
+    metrics = []
+
     def __init__(self, collectd, name, default_port, json_provider=None, verbose=False, interval=None):
         self.collectd = collectd
         self.name = name
         self.default_port = default_port
-        self.json_provider = json_provider
         self.verbose = verbose
         self.interval = interval
         self.emitter = MetricEmitter(self.collectd, self.name)
+        self.self_emitter = MetricEmitter(self.collectd, self.name)
         self.include_timing_histograms = True
+        self.histograms = HistogramEngine()
+        self.fetch_pool = FetchPool()
+        self.deadline = None
+        self.keep_alive = True
+        self.async_fetch = False
+        self.stagger = 0.0
+        self.worker_processes = 0
+        self.streaming_parse = False
+        self.batch_dispatch = False
+        self.trace = False
+        self.include_self_metrics = True
+        self.suppress_unchanged = False
+        self.heartbeat = DEFAULT_HEARTBEAT
+        self.emit_rates = False
+        self.emit_deltas = False
+        self.emit_raw_counters = True
+        self.reuse_unchanged = False
+        self.server_filter = False
+        self.filter_param = UrlJsonProvider.filter_param
+        self.compression = 'false'
+        # Compression settings overriding compression for single targets, by "host:port" or port
+        self.target_compression = {}
+        self.cardinality_limit = None
+        self.cardinality_limits = {}
+        self.group_intervals = {}
+        self.fetch_cache_ttl = 0.0
+        self.target = None
+        self.metric_spec_file = None
+        self.plan = None
+        self.cycle_budget = None
+        # When the budget of the current read runs out, shared by all its targets
+        self.budget_deadline = None
+        self.key_errors = 0
+        self.series_folded = 0
+        self.steps_deferred = 0
+        self.discovery = None
+        self.provider_cls = PooledUrlJsonProvider
+        self.static_targets = []
+        self.discovered_targets = {}
+        self.targets = []
+        if json_provider:
+            self.targets.append(Target(self.name, json_provider, self.emitter))
 
     def configure_callback(self, conf):
-        json_provider = UrlJsonProvider(port=self.default_port)
+        host = "localhost"
+        path = "/debug/vars"
+        ports = []
+        urls = []
+        discovery = None
+        discovery_interval = DEFAULT_DISCOVERY_INTERVAL
+        discovery_port = 'vt'
         for node in conf.children:
-            if node.key == 'URL':
-                json_provider.url = node.values[0]
+            if node.key == 'Host':
+                host = node.values[0]
+            elif node.key == 'URL':
+                urls.extend(node.values)
             elif node.key == 'Port':
-                json_provider.port = node.values[0]
+                ports.extend(parse_ports(node.values))
             elif node.key == 'Path':
-                json_provider.path = node.values[0]
+                path = node.values[0]
             elif node.key == 'Interval':
                 self.interval = int(node.values[0])
             elif node.key == 'Verbose':
                 self.verbose = boolval(node.values[0])
             elif node.key == 'IncludeTimingHistograms':
-                self.include_timing_histograms = util.boolval(node.values[0])
-
-        handler = CollectdLogHandler(self.collectd, self.name, self.verbose)
+                self.include_timing_histograms = boolval(node.values[0])
+            elif node.key == 'TimingPercentiles':
+                self.histograms.percentiles = [float(value) for value in node.values]
+            elif node.key == 'FetchThreads':
+                self.fetch_pool.size = int(node.values[0])
+            elif node.key == 'ReadDeadline':
+                self.deadline = float(node.values[0])
+            elif node.key == 'CycleBudget':
+                self.cycle_budget = float(node.values[0])
+            elif node.key == 'KeepAlive':
+                self.keep_alive = boolval(node.values[0])
+            elif node.key == 'AsyncFetch':
+                self.async_fetch = boolval(node.values[0])
+            elif node.key == 'StaggerFetches':
+                self.stagger = float(node.values[0])
+            elif node.key == 'WorkerProcesses':
+                self.worker_processes = int(node.values[0])
+            elif node.key == 'Discovery':
+                discovery = node.values[0]
+            elif node.key == 'DiscoveryInterval':
+                discovery_interval = float(node.values[0])
+            elif node.key == 'DiscoveryPortName':
+                discovery_port = node.values[0]
+            elif node.key == 'StreamingParse':
+                self.streaming_parse = boolval(node.values[0])
+            elif node.key == 'BatchDispatch':
+                self.batch_dispatch = boolval(node.values[0])
+            elif node.key == 'Trace':
+                self.trace = boolval(node.values[0])
+            elif node.key == 'IncludeSelfMetrics':
+                self.include_self_metrics = boolval(node.values[0])
+            elif node.key == 'SuppressUnchanged':
+                self.suppress_unchanged = boolval(node.values[0])
+            elif node.key == 'HeartbeatInterval':
+                self.heartbeat = float(node.values[0])
+            elif node.key == 'EmitRates':
+                self.emit_rates = boolval(node.values[0])
+            elif node.key == 'EmitDeltas':
+                self.emit_deltas = boolval(node.values[0])
+            elif node.key == 'EmitRawCounters':
+                self.emit_raw_counters = boolval(node.values[0])
+            elif node.key == 'ReuseUnchanged':
+                self.reuse_unchanged = boolval(node.values[0])
+            elif node.key == 'ServerSideFilter':
+                self.server_filter = boolval(node.values[0])
+            elif node.key == 'FilterParam':
+                self.filter_param = node.values[0]
+            elif node.key == 'Compression':
+                self.compression = str(node.values[0]).lower()
+            elif node.key == 'CompressionTarget':
+                self.target_compression[str(node.values[0])] = str(node.values[1]).lower()
+            elif node.key == 'CardinalityLimit':
+                self.cardinality_limit = int(node.values[0])
+            elif node.key == 'CardinalityLimitMetric':
+                self.cardinality_limits[node.values[0]] = int(node.values[1])
+            elif node.key == 'GroupInterval':
+                self.group_intervals[node.values[0]] = max(int(node.values[1]), 1)
+            elif node.key == 'FetchCacheTTL':
+                self.fetch_cache_ttl = float(node.values[0])
+            elif node.key == 'FetchCacheMaxBytes':
+                # The cache is process wide, so the last module configured sets its bounds
+                fetch_cache.max_bytes = int(node.values[0])
+            elif node.key == 'FetchCacheMaxEntries':
+                fetch_cache.max_entries = int(node.values[0])
+            elif node.key == 'MetricSpecFile':
+                self.metric_spec_file = node.values[0]
+
+        # Tracing is logged at debug level, so it needs a verbose handler
+        handler = CollectdLogHandler(self.collectd, self.name, self.verbose or self.trace)
         handler.register()
+        tracer.enabled = tracer.enabled or self.trace
+
+        if not ports and not urls and not discovery:
+            ports = [str(self.default_port)]
+        if self.async_fetch:
+            if self.fetch_stagger() < self.stagger:
+                logger.warning("StaggerFetches %.1f would start fetches too late to finish within the %.1fs ReadDeadline, using %.1f"
+                               % (self.stagger, self.read_deadline(), self.fetch_stagger()))
+            self.fetch_pool = AsyncFetchPool(self.fetch_pool.size, self.fetch_stagger())
+            self.provider_cls = AsyncUrlJsonProvider
+        else:
+            self.provider_cls = PooledUrlJsonProvider if self.keep_alive else UrlJsonProvider
+        providers = [self.provider_cls(host=host, port=port, path=path) for port in ports]
+        providers.extend([self.provider_cls.from_url(url) for url in urls])
+        for provider in providers:
+            provider.timeout = self.fetch_timeout()
+        multi = len(providers) > 1 or discovery is not None
+        self.targets = self.static_targets = [self.create_target(provider, multi) for provider in providers]
+        if discovery:
+            self.discovery = TargetDiscovery(discovery, discovery_interval, discovery_port, path, self.read_deadline())
+
+    def create_target(self, json_provider, multi=False):
+        """Creates a Target for json_provider
+
+        When a collector polls a single target its metrics are reported
+        under the collector's name, as they always have been.  With multiple
+        targets each one is reported as <name>_<port>, or
+        <name>_<host>_<port> for remote hosts.
+        """
+        if not multi:
+            name = self.name
+        elif json_provider.host in ("localhost", "127.0.0.1"):
+            name = "%s_%s" % (self.name, json_provider.port)
+        else:
+            name = "%s_%s_%s" % (self.name, json_provider.host.replace('.', '_'), json_provider.port)
+        heartbeat = self.heartbeat if self.suppress_unchanged else None
+        emitter = MetricEmitter(self.collectd, name, batch=self.batch_dispatch, heartbeat=heartbeat,
+                                rates=self.emit_rates, deltas=self.emit_deltas, raw_counters=self.emit_raw_counters)
+        target = Target(name, json_provider, emitter)
+        target.health.base_delay = self.interval or BACKOFF_BASE
+        self._configure_provider(json_provider, self.json_keys() if self.plan is not None else None)
+        return target
+
+    def json_keys(self):
+        """Returns the top level /debug/vars keys the compiled plan reads
+
+        Used to skip parsing everything else when StreamingParse is on.
+        """
+        return sorted(set(step.section for step in self.plan))
 
-        self.json_provider = json_provider
+    def compile_plan(self):
+        """Compiles the metric catalogue into a list of PlanSteps
+
+        Entries whose flag is off are left out, and names, tag parsers and
+        transformers are resolved here rather than on every read.  Steps are
+        ordered by tier, so the most important metrics are processed first.
+        """
+        spec = self.metrics
+        if self.metric_spec_file:
+            spec = merge_metric_spec(spec, load_metric_spec(self.metric_spec_file))
+        plan = []
+        for entry in spec:
+            flag = entry.get('flag')
+            if flag and not getattr(self, flag):
+                continue
+            plan.append(self._compile_step(entry))
+        plan.sort(key=lambda step: step.tier)
+        return plan
+
+    def _compile_step(self, entry):
+        kind = entry.get('kind', 'metric')
+        name = entry['name']
+        if kind == 'metric':
+            run = self._compile_metric(entry)
+        elif kind == 'timing':
+            parse_tags = entry.get('tags')
+            run = lambda json_data: self.process_timing_data(json_data, name, parse_tags=parse_tags)
+        elif kind == 'histogram':
+            run = lambda json_data: self.process_histogram(json_data, name)
+        elif kind == 'custom':
+            method = getattr(self, entry['method'])
+            args = entry.get('args', [])
+            run = lambda json_data: method(json_data, name, *args)
+        else:
+            raise ValueError("Unknown kind '%s' of metric %s" % (kind, name))
+        tier = entry.get('tier')
+        if tier is None:
+            if entry.get('flag') or kind == 'histogram':
+                tier = TIER_DETAIL
+            elif kind == 'timing':
+                tier = TIER_TIMINGS
+            else:
+                tier = TIER_CORE
+        every = self.group_intervals.get(entry.get('group', name), 1)
+        return PlanStep(kind, name, entry.get('source', name), run, tier, every)
+
+    def _compile_metric(self, entry):
+        name = entry['name']
+        metric_type = entry['type']
+        source = entry.get('source')
+        emit_name = "%s%s" % (entry.get('prefix', ''), entry.get('alt_name') or name)
+        transformer = TRANSFORMERS[entry['transformer']] if entry.get('transformer') else None
+        tag_list = entry.get('tags')
+
+        if not tag_list:
+            def run(json_data):
+                value = (json_data[source] if source else json_data)[name]
+                if transformer:
+                    value = transformer(value)
+                self.emitter.emit(emit_name, value, metric_type)
+            return run
+
+        parse = get_tag_parser(tag_list).parse
+        def run(json_data):
+            values = (json_data[source] if source else json_data)[name]
+            if type(values) is not dict:
+                tagged_values = [(parse(name), values)]
+            else:
+                tagged_values = [(parse(key), value) for key, value in values.iteritems()]
+            limiter = self.cardinality_limiter(name)
+            if limiter:
+                tagged_values = limiter.select(tagged_values, metric_type, tag_list)
+                self.series_folded += limiter.folded
+            emit = self.emitter.emit
+            for tags, value in tagged_values:
+                if transformer:
+                    value = transformer(value)
+                emit(emit_name, value, metric_type, tags)
+        return run
+
+    def prepare(self):
+        """Compiles the plan and sets targets up once configuration is complete"""
+        self.plan = self.compile_plan()
+        keys = self.json_keys()
+        for target in self.targets:
+            self._configure_provider(target.json_provider, keys)
+        if self.worker_processes and not isinstance(self.fetch_pool, ProcessPool):
+            self.fetch_pool = ProcessPool(self.worker_processes, fallback=self.fetch_pool)
+            self.fetch_pool.start(self)
+
+    def _configure_provider(self, json_provider, keys):
+        # Server side filtering falls back to streaming filtering, so it needs the keys either way
+        json_provider.keys = keys if self.streaming_parse or self.server_filter else None
+        json_provider.track_changes = self.reuse_unchanged
+        if isinstance(json_provider, UrlJsonProvider):
+            json_provider.server_filter = self.server_filter
+            json_provider.filter_param = self.filter_param
+            json_provider.cache = fetch_cache if self.fetch_cache_ttl else None
+            json_provider.cache_ttl = self.fetch_cache_ttl
+            compression = self.target_compression.get("%s:%s" % (json_provider.host, json_provider.port),
+                                                      self.target_compression.get(str(json_provider.port), self.compression))
+            if compression == 'remote':
+                json_provider.compression = json_provider.host not in ("localhost", "127.0.0.1")
+            else:
+                json_provider.compression = boolval(compression)
+
+    def process_data(self, json_data):
+        if self.plan is None:
+            self.plan = self.compile_plan()
+        plan = self.plan
+        target = self.target
+        order = self._due_steps(target) if target is not None else xrange(len(plan))
+        if self.cycle_budget:
+            return self._process_budgeted(json_data, target, order)
+        if target is None or not target.json_provider.track_changes:
+            for i in order:
+                self._run_step(plan[i], json_data)
+            return
+        for i in order:
+            self._run_tracked_step(i, json_data, target)
+
+    def _due_steps(self, target):
+        """Returns the indexes of the plan steps due on this read of target
+
+        Every step runs on the first read, and then on every step.every reads.
+        All the steps due on a read share its single fetch of /debug/vars.
+        Steps deferred by the last read are always due.
+        """
+        read = target.reads
+        target.reads += 1
+        deferred = target.deferred
+        due = [i for i, step in enumerate(self.plan) if read % step.every == 0 or i in deferred]
+        if target.json_provider.track_changes and len(due) < len(self.plan):
+            # Sections may have changed while their steps weren't due, so what they recorded can't be replayed
+            upcoming = set(step.section for step in self.plan if step.every > 1 and (read + 1) % step.every == 0)
+            if upcoming:
+                target.json_provider.forget(upcoming)
+        return due
+
+    def _process_budgeted(self, json_data, target, order):
+        """Runs the steps in order until the read's budget is spent, then defers all but TIER_CORE steps
+
+        The budget of cycle_budget seconds is shared by every target of a
+        read, see process_target().  Steps deferred by the last read of target run first within their
+        tier, and once the budget is spent the one deferred for longest still
+        runs, so every step is processed in turn even when TIER_CORE steps
+        alone use up the budget.
+        """
+        plan = self.plan
+        deferred = target.deferred if target is not None else {}
+        catch_up = None
+        if deferred:
+            order = sorted(order, key=lambda i: (plan[i].tier, i not in deferred))
+            catch_up = min(deferred, key=lambda i: (deferred[i], i))
+        read = target.reads if target is not None else 0
+        track_changes = target is not None and target.json_provider.track_changes
+        deadline = self.budget_deadline
+        if deadline is None:
+            deadline = time.time() + self.cycle_budget
+        now_deferred = {}
+        for i in order:
+            step = plan[i]
+            if step.tier != TIER_CORE and i != catch_up and time.time() > deadline:
+                now_deferred[i] = deferred.get(i, read)
+                continue
+            if track_changes:
+                self._run_tracked_step(i, json_data, target)
+            else:
+                self._run_step(step, json_data)
+        if now_deferred:
+            logger.debug("Deferred %d steps after exceeding the %.3fs cycle budget", len(now_deferred), self.cycle_budget)
+        self.steps_deferred = len(now_deferred)
+        if target is not None:
+            target.deferred = now_deferred
+            # Whatever the deferred steps recorded is out of date, so have their sections decoded for the next read
+            if track_changes and now_deferred:
+                target.json_provider.forget(set(plan[i].section for i in now_deferred))
+
+    def _run_tracked_step(self, i, json_data, target):
+        # Steps reading a section that hasn't changed since the last read emit what they did then
+        step = self.plan[i]
+        recorded = target.recorded.get(i)
+        if step.section in target.json_provider.unchanged:
+            if recorded is not None:
+                self.emitter.replay(recorded)
+                target.stats.sections_reused += 1
+            else:
+                # Never ran on this section's data, which wasn't decoded; it will be on the next read
+                target.json_provider.forget((step.section,))
+            return
+        self.emitter.record()
+        try:
+            self._run_step(step, json_data)
+        finally:
+            target.recorded[i] = self.emitter.stop_recording()
+
+    def _run_step(self, step, json_data):
+        try:
+            step.run(json_data)
+        except KeyError, e:
+            self.key_errors += 1
+            logger.warning("[KeyError] %s: Failed to get '%s' from json data. Skipping." % (step.kind, step.name))
+
+    def read_deadline(self):
+        """Seconds a read callback may spend fetching and processing
+
+        Defaults to the configured Interval so a read never overruns it.
+        """
+        return self.deadline or self.interval or DEFAULT_DEADLINE
+
+    def fetch_timeout(self):
+        """Seconds a single fetch may wait on its target
+
+        Shorter than read_deadline(), so a hung target times out while the
+        read is still waiting on it, and is backed off like any failure.
+        """
+        return self.read_deadline() * FETCH_TIMEOUT_RATIO
+
+    def fetch_stagger(self):
+        """Seconds over which to spread the start of fetches
+
+        StaggerFetches, clamped so that a fetch started last still times out
+        within read_deadline().
+        """
+        return min(self.stagger, max(self.read_deadline() - self.fetch_timeout(), 0.0))
 
     def register_read_callback(self):
+        # Called at the end of configure_callback, once subclasses have parsed their options
+        self.prepare()
+        if self.discovery:
+            self.discovery.start()
+
         if self.interval:
             self.collectd.register_read(self.read_callback, interval=self.interval)
         else:
             self.collectd.register_read(self.read_callback)
 
     def read_callback(self):
-        json = self.json_provider.get_json()
-        self.process_data(json)
+        try:
+            self._read()
+        finally:
+            for target in self.targets:
+                with tracer.phase('dispatch', target.name):
+                    target.emitter.flush()
+
+    def sync_targets(self):
+        """Adds and removes targets to match what discovery last found"""
+        urls = self.discovery.urls if self.discovery else None
+        if urls is None:
+            return
+        known = set(self.discovered_targets)
+        static = set(target.json_provider.url() for target in self.static_targets)
+        removed = known - urls
+        added = urls - known - static
+        for url in removed:
+            target = self.discovered_targets.pop(url)
+            if isinstance(self.fetch_pool, ProcessPool):
+                self.fetch_pool.forget(url)
+            logger.notice("Target %s is gone, no longer polling it" % target.name)
+        for url in added:
+            provider = self.provider_cls.from_url(url)
+            provider.timeout = self.fetch_timeout()
+            target = self.discovered_targets[url] = self.create_target(provider, True)
+            logger.notice("Discovered target %s" % target.name)
+        if removed or added:
+            self.targets = self.static_targets + [self.discovered_targets[url] for url in sorted(self.discovered_targets)]
+
+    def _read(self):
+        start = time.time()
+        deadline = start + self.read_deadline()
+        self.budget_deadline = start + self.cycle_budget if self.cycle_budget else None
+        results = Queue.Queue()
+        pending = set()
+        self.sync_targets()
+        for target in self.targets:
+            if target.in_flight:
+                logger.warning("Previous fetch for %s is still running. Skipping." % target.name)
+                target.stats.skipped_fetches += 1
+                continue
+            if not target.health.should_fetch(start):
+                logger.debug("Backing off from failing target %s. Skipping.", target.name)
+                target.stats.skipped_fetches += 1
+                continue
+            self.fetch_pool.submit(target, results)
+            pending.add(target)
+
+        while pending:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    target, json_data, error = results.get(timeout=remaining)
+                else:
+                    # Out of time, but fetches that already completed are still taken
+                    target, json_data, error = results.get_nowait()
+            except Queue.Empty:
+                # Their results will go unread, so back them off here or they'd hold up every read
+                stalled = [target for target in pending if target.in_flight]
+                if stalled:
+                    logger.warning("Timed out waiting on %d fetches. Skipping them this interval." % len(stalled))
+                for target in stalled:
+                    self._fetch_failed(target, "timed out after %.1fs" % self.read_deadline())
+                break
+            pending.discard(target)
+            if error:
+                self._fetch_failed(target, error)
+                continue
+            if target.health.state == TargetHealth.FAILING:
+                logger.notice("Target %s recovered" % target.name)
+            target.health.record_success()
+            if isinstance(json_data, RenderedRead):
+                self.dispatch_rendered(target, json_data)
+            else:
+                self.process_target(target, json_data, self.budget_deadline)
+
+        if self.include_self_metrics:
+            for target in self.targets:
+                self.emit_self_metrics(target)
+
+        # Worker processes have connection pools of their own
+        if not isinstance(self.fetch_pool, ProcessPool) and \
+                any(isinstance(target.json_provider, PooledUrlJsonProvider) for target in self.targets):
+            stats = connection_pool.stats()
+            logger.info("HTTP connection pool: %d requests, %d reconnects, %.1f%% reused",
+                        stats['requests'], stats['reconnects'], stats['reuse_ratio'] * 100)
+            if self.include_self_metrics:
+                self.self_emitter.emit(SELF_METRICS_PREFIX + 'HttpRequests', stats['requests'], 'counter')
+                self.self_emitter.emit(SELF_METRICS_PREFIX + 'HttpConnectionReuseRatio', stats['reuse_ratio'], 'gauge')
+
+        if self.fetch_cache_ttl and not isinstance(self.fetch_pool, (ProcessPool, AsyncFetchPool)) and \
+                fetch_cache.reports(self):
+            stats = fetch_cache.stats()
+            logger.info("Fetch cache: %d hits, %d shared, %d misses, %d evictions, %d entries of %d bytes",
+                        stats['hits'], stats['shared'], stats['misses'], stats['evictions'], stats['entries'], stats['bytes'])
+            if self.include_self_metrics:
+                emit = self.self_emitter.emit
+                emit(SELF_METRICS_PREFIX + 'FetchCacheHits', stats['hits'], 'counter')
+                emit(SELF_METRICS_PREFIX + 'FetchCacheShared', stats['shared'], 'counter')
+                emit(SELF_METRICS_PREFIX + 'FetchCacheMisses', stats['misses'], 'counter')
+                emit(SELF_METRICS_PREFIX + 'FetchCacheEvictions', stats['evictions'], 'counter')
+                emit(SELF_METRICS_PREFIX + 'FetchCacheBytes', stats['bytes'], 'gauge')
+
+    def _fetch_failed(self, target, error):
+        delay = target.health.record_failure(time.time())
+        target.stats.reset()
+        target.stats.fetch_errors += 1
+        logger.error("Failed to get json data for %s: %s. Retrying in %.1fs" % (target.name, error, delay))
+
+    def process_target(self, target, json_data, budget_deadline=None):
+        """Processes a read of target
+
+        budget_deadline is when the CycleBudget of the read runs out, so that
+        all the targets of a read share it; by default target gets a budget
+        of its own.
+        """
+        # process_* helpers emit through self.emitter, so point it at this target's emitter
+        self.emitter = target.emitter
+        self.target = target
+        self.budget_deadline = budget_deadline
+        self.key_errors = 0
+        self.series_folded = 0
+        self.steps_deferred = 0
+        emitted = target.emitter.emitted
+        suppressed = target.emitter.suppressed
+        counter_resets = target.emitter.counter_resets
+        start = time.time()
+        target.emitter.begin_read()
+        target.emitter.timestamp = start
+        target.stats.sections_reused = 0
+        with tracer.phase('process', target.name):
+            self.process_data(json_data)
+
+        stats = target.stats
+        stats.process_time = time.time() - start
+        stats.values_emitted = target.emitter.emitted - emitted
+        stats.values_suppressed = target.emitter.suppressed - suppressed
+        stats.counter_resets = target.emitter.counter_resets - counter_resets
+        stats.key_errors = self.key_errors
+        stats.series_folded = self.series_folded
+        stats.steps_deferred = self.steps_deferred
+        stats.deferred_steps += self.steps_deferred
+        stats.fetch_time = target.json_provider.fetch_time
+        stats.parse_time = target.json_provider.parse_time
+        stats.response_bytes = target.json_provider.response_bytes
+        stats.bytes_saved = target.json_provider.bytes_saved
+        stats.transfer_bytes = target.json_provider.transfer_bytes
+
+    def dispatch_rendered(self, target, rendered):
+        """Dispatches a read of target processed by a worker process"""
+        target.emitter.begin_read()
+        dispatch = target.emitter.dispatch_rendered
+        for type_instance, type, values in rendered.values:
+            dispatch(type_instance, type, values)
+        target.stats.update(rendered.stats)
+
+    def emit_self_metrics(self, target):
+        """Reports how the last read of target went, under SELF_METRICS_PREFIX"""
+        stats = target.stats
+        # Failed reads never reach process_target, so time the counters below here
+        target.emitter.timestamp = time.time()
+        emit = target.emitter.emit
+        emit(SELF_METRICS_PREFIX + 'FetchTime', stats.fetch_time * 1000, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'ParseTime', stats.parse_time * 1000, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'ResponseBytes', stats.response_bytes, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'BytesSaved', stats.bytes_saved, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'TransferBytes', stats.transfer_bytes, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'ProcessTime', stats.process_time * 1000, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'ValuesDispatched', stats.values_emitted, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'ValuesSuppressed', stats.values_suppressed, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'CounterResets', stats.counter_resets, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'SeriesFolded', stats.series_folded, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'SectionsReused', stats.sections_reused, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'KeyErrors', stats.key_errors, 'gauge')
+        emit(SELF_METRICS_PREFIX + 'FetchErrors', stats.fetch_errors, 'counter')
+        emit(SELF_METRICS_PREFIX + 'SkippedFetches', stats.skipped_fetches, 'counter')
+        emit(SELF_METRICS_PREFIX + 'DeferredSteps', stats.deferred_steps, 'counter')
+        emit(SELF_METRICS_PREFIX + 'ConsecutiveFailures', target.health.failures, 'gauge')
 
     def process_timing_data(self, json_data, timing_name, parse_tags=None):
         try:
@@ -353,24 +2725,23 @@ class BaseCollector(object):
             self.process_metric(timing_values, 'TotalCount', 'counter', prefix=timing_name)
             self.process_metric(timing_values, 'TotalTime', 'counter', prefix=timing_name, transformer=nsToMs)
 
-            for key, histogram in timing_values['Histograms'].items():
-                if parse_tags:
-                    tags = _extract_tags(key, tag_list=parse_tags)
+            parse = get_tag_parser(parse_tags).parse if parse_tags else None
+            state = self.target.histograms if self.target is not None else None
+            include_buckets = self.include_timing_histograms
+            emit = self.emitter.emit
+            for key, histogram in timing_values['Histograms'].iteritems():
+                if parse:
+                    tags = parse(key) or None
                     prefix = timing_name
                 else:
                     tags = None
                     prefix = "%s%s" % (timing_name, upperSnakeToCamel(key))
-                self.process_metric(histogram, 'Count', 'counter', prefix=prefix, base_tags=tags)
-                self.process_metric(histogram, 'Time', 'counter', prefix=prefix, base_tags=tags, transformer=nsToMs)
-
-                if self.include_timing_histograms:
-                    def nsKeysToMs(key):
-                        if key.isdigit():
-                            return "%d" % nsToMs(long(key))
-                        return key
-
-                    self.process_histogram(timing_values['Histograms'], key, prefix=timing_name, alt_name="", suffix="Time", tags=tags, key_transformer=nsKeysToMs)
+                emit(prefix + 'Count', histogram['Count'], 'counter', tags)
+                emit(prefix + 'Time', nsToMs(histogram['Time']), 'counter', tags)
+                # Untagged histograms are told apart by their key, tagged ones by their tags
+                self.histograms.emit(self.emitter, prefix + 'Time', histogram, tags, include_buckets, state)
         except KeyError, e:
+            self.key_errors += 1
             logger.warning("[KeyError] process_timing_data: Failed to get timing_name '%s' from json data. Skipping." % timing_name)
 
     def process_histogram(self, json_data, metric_name, prefix="", alt_name=None, suffix="", key_transformer=None, tags=None):
@@ -385,19 +2756,37 @@ class BaseCollector(object):
 
                 self.emitter.emit("%s%s%sHistogram.%s" % (prefix, alt_name if alt_name is not None else upperSnakeToCamel(metric_name), suffix, key), value, 'gauge', tags)
         except KeyError, e:
+            self.key_errors += 1
             logger.warning("[KeyError] process_histogram: Failed to get metric_name '%s' from json data. Skipping." % metric_name)
 
     def process_metric(self, json_data, metric_name, type, prefix="", alt_name=None, base_tags=dict(), parse_tags=dict(), transformer=None):
         try:
-            for tags, value in self._extract_values(json_data, metric_name, parse_tags):
+            tagged_values = self._extract_values(json_data, metric_name, parse_tags)
+            if parse_tags:
+                limiter = self.cardinality_limiter(metric_name)
+                if limiter:
+                    tagged_values = limiter.select(tagged_values, type, parse_tags)
+                    self.series_folded += limiter.folded
+            for tags, value in tagged_values:
                 all_tags = base_tags.copy() if base_tags else dict()
                 all_tags.update(tags)
                 if transformer:
                     value = transformer(value)
                 self.emitter.emit("%s%s" % (prefix, alt_name if alt_name else metric_name), value, type, None if not len(all_tags) else all_tags)
         except KeyError, e:
+            self.key_errors += 1
             logger.warning("[KeyError] process_metric: Failed to get metric_name '%s' from json data. Skipping." % metric_name)
 
+    def cardinality_limiter(self, metric_name):
+        """Returns the current target's CardinalityLimiter for metric_name, if it has a limit"""
+        limit = self.cardinality_limits.get(metric_name, self.cardinality_limit)
+        if not limit or self.target is None:
+            return None
+        limiter = self.target.limiters.get(metric_name)
+        if limiter is None:
+            limiter = self.target.limiters[metric_name] = CardinalityLimiter(limit)
+        return limiter
+
     def _extract_values(self, json_data, metric_name, parse_tags):
         if parse_tags:
             return extract_tagged_values(json_data, metric_name, tag_list=parse_tags)
@@ -410,7 +2799,7 @@ def run_local(name, collector):
     parser.add_argument('--host', action='store',
                         help='Host to get JSON from', default="localhost")
     parser.add_argument('--port', action='store',
-                        help='Port on host to get JSON from', default="15101")
+                        help='Port(s) on host to get JSON from, i.e. 15101 or 15101-15140', default="15101")
     parser.add_argument('--host-path', action='store',
                         help='Path on host to get JSON from', default="/debug/vars")
     parser.add_argument('--file-path', action='store',
@@ -419,18 +2808,72 @@ def run_local(name, collector):
                         help='How often (seconds) to output values', default=10)
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Whether to run in verbose mode')
+    parser.add_argument('--streaming-parse', action='store_true',
+                        help='Only parse the keys the collector uses')
+    parser.add_argument('--batch-dispatch', action='store_true',
+                        help='Dispatch all values at the end of each read')
+    parser.add_argument('--trace', action='store_true',
+                        help='Log method calls and how long each phase of a read takes')
+    parser.add_argument('--async-fetch', action='store_true',
+                        help='Fetch all ports concurrently on a single event loop thread')
+    parser.add_argument('--stagger', action='store', type=float, default=0.0,
+                        help='Seconds over which to spread the start of fetches')
+    parser.add_argument('--server-side-filter', action='store_true',
+                        help='Ask the server for just the keys the collector uses')
+    parser.add_argument('--compression', action='store', default='false',
+                        help='Ask for compressed responses: true, false or remote (only for other hosts)')
+    parser.add_argument('--reuse-unchanged', action='store_true',
+                        help='Reuse the results of sections that did not change since the last read')
+    parser.add_argument('--discovery', action='store',
+                        help='vtctld url or file listing the tablets to poll')
+    parser.add_argument('--worker-processes', action='store', type=int, default=0,
+                        help='Fetch and process targets in this many worker processes')
+    parser.add_argument('--cycle-budget', action='store', type=float,
+                        help='Seconds each read may spend processing before deferring lower priority metrics')
+    parser.add_argument('--group-interval', action='append', default=[], metavar='GROUP=N',
+                        help='Collect a metric group only every N reads, may be repeated')
+    parser.add_argument('--fetch-cache-ttl', action='store', type=float, default=0.0,
+                        help='Seconds fetched payloads are shared with other reads of the same url')
 
     args = parser.parse_args()
     if args.file_path:
-        json_provider = FileJsonProvider(args.file_path)
+        json_providers = [FileJsonProvider(args.file_path)]
+    elif args.async_fetch:
+        json_providers = [AsyncUrlJsonProvider(host=args.host, port=port, path=args.host_path) for port in parse_ports([args.port])]
     else:
-        json_provider = UrlJsonProvider(host=args.host, port=args.port, path=args.host_path)
+        json_providers = [PooledUrlJsonProvider(host=args.host, port=port, path=args.host_path) for port in parse_ports([args.port])]
 
     collectd = mock.CollectdMock(name)
-    handler = CollectdLogHandler(collectd, '%s-mock' % name, verbose=args.verbose)
+    handler = CollectdLogHandler(collectd, '%s-mock' % name, verbose=args.verbose or args.trace)
     handler.register()
-
-    vt = collector(collectd, json_provider, args.verbose)
+    tracer.enabled = args.trace
+
+    vt = collector(collectd, None, args.verbose, int(args.interval) or None)
+    for json_provider in json_providers:
+        if isinstance(json_provider, UrlJsonProvider):
+            json_provider.timeout = vt.fetch_timeout()
+    vt.streaming_parse = args.streaming_parse
+    vt.batch_dispatch = args.batch_dispatch
+    if args.async_fetch:
+        vt.stagger = args.stagger
+        vt.fetch_pool = AsyncFetchPool(vt.fetch_pool.size, vt.fetch_stagger())
+    vt.worker_processes = args.worker_processes
+    vt.reuse_unchanged = args.reuse_unchanged
+    vt.server_filter = args.server_side_filter
+    vt.compression = args.compression.lower()
+    vt.cycle_budget = args.cycle_budget
+    vt.fetch_cache_ttl = args.fetch_cache_ttl
+    for group_interval in args.group_interval:
+        group, every = group_interval.split('=', 1)
+        vt.group_intervals[group] = max(int(every), 1)
+    if args.discovery:
+        json_providers = []
+        vt.discovery = TargetDiscovery(args.discovery, path=args.host_path)
+        vt.discovery.refresh()
+    vt.targets = vt.static_targets = [vt.create_target(json_provider, len(json_providers) > 1) for json_provider in json_providers]
+    vt.prepare()
+    if vt.discovery:
+        vt.discovery.start()
     interval = int(args.interval)
     while True:
         vt.read_callback()
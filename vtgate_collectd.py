@@ -7,77 +7,87 @@ import util
 import mock
 
 NAME = 'vtgate'
+# Multi-value type for 1/5/15 minute rates, which must be added to collectd's types.db when GroupRates is enabled
+RATES_TYPE = 'vitess_rates'
+HEALTHCHECK_TAGS = ['keyspace', 'shard', 'type']
+SHARD_CALL_TAGS = ['Operation', 'Keyspace', 'ShardName', 'DbType']
+BUFFER_TAGS = ['Keyspace', 'ShardName']
+
+# The metrics collected from /debug/vars, compiled into an extraction plan by util.BaseCollector.compile_plan
+METRICS = [
+    # Current connections and total accepted
+    {'name': 'ConnAccepted', 'type': 'counter'},
+    {'name': 'ConnCount', 'type': 'gauge'},
+
+    # healthcheck metrics, both errors and connections
+    {'name': 'HealthcheckErrors', 'type': 'counter', 'tags': HEALTHCHECK_TAGS},
+    {'name': 'HealthcheckConnections', 'type': 'gauge', 'tags': HEALTHCHECK_TAGS},
+
+    # GC Stats
+    {'name': 'GCCPUFraction', 'source': 'memstats', 'type': 'counter', 'prefix': 'GC.', 'alt_name': 'CPUFraction'},
+    {'name': 'PauseTotalNs', 'source': 'memstats', 'type': 'counter', 'prefix': 'GC.'},
+
+    # We should endeavor to have 0 statements that are unfriendly to filtered replication for any keyspaces that want to be sharded
+    {'name': 'FilteredReplicationUnfriendlyStatementsCount', 'type': 'counter'},
+
+    {'kind': 'custom', 'name': 'QPSByDbType', 'method': 'process_rates', 'args': ['DbType']},
+    {'kind': 'custom', 'name': 'QPSByKeyspace', 'method': 'process_rates', 'args': ['Keyspace']},
+    {'kind': 'custom', 'name': 'QPSByOperation', 'method': 'process_rates', 'args': ['Operation']},
+    {'kind': 'custom', 'name': 'ErrorsByDbType', 'method': 'process_rates', 'args': ['DbType']},
+    {'kind': 'custom', 'name': 'ErrorsByKeyspace', 'method': 'process_rates', 'args': ['Keyspace']},
+    {'kind': 'custom', 'name': 'ErrorsByOperation', 'method': 'process_rates', 'args': ['Operation']},
+    {'kind': 'custom', 'name': 'ErrorsByCode', 'method': 'process_rates', 'args': ['Code']},
+
+    # Subtracting VtgateApi from VttabletCall times below should allow seeing what overhead vtgate adds
+    {'kind': 'timing', 'name': 'VtgateApi', 'tags': ['Operation', 'Keyspace', 'DbType']},
+    {'name': 'VtgateApiErrorCounts', 'type': 'counter', 'tags': ['Operation', 'Keyspace', 'DbType', 'Code']},
+
+    {'name': 'VttabletCallErrorCount', 'type': 'counter', 'tags': SHARD_CALL_TAGS},
+    {'kind': 'timing', 'name': 'VttabletCall', 'tags': SHARD_CALL_TAGS},
+
+    {'name': 'BufferUtilizationSum', 'type': 'counter', 'tags': BUFFER_TAGS},
+    {'name': 'BufferStarts', 'type': 'counter', 'tags': BUFFER_TAGS},
+    {'name': 'BufferRequestsBuffered', 'type': 'counter', 'tags': BUFFER_TAGS},
+    {'name': 'BufferRequestsDrained', 'type': 'counter', 'tags': BUFFER_TAGS},
+
+    {'name': 'BufferRequestsEvicted', 'type': 'counter', 'tags': BUFFER_TAGS + ['Reason']},
+    {'name': 'BufferRequestsSkipped', 'type': 'counter', 'tags': BUFFER_TAGS + ['Reason']},
+]
 
 class Vtgate(util.BaseCollector):
+    metrics = METRICS
+
     def __init__(self, collectd, json_provider=None, verbose=False, interval=None):
         super(Vtgate, self).__init__(collectd, NAME, 15001, json_provider, verbose, interval)
+        self.group_rates = False
 
     def configure_callback(self, conf):
         super(Vtgate, self).configure_callback(conf)
 
         for node in conf.children:
-            pass
+            if node.key == 'GroupRates':
+                self.group_rates = util.boolval(node.values[0])
 
         self.register_read_callback()
 
-    def process_data(self, json_data):
-        # Current connections and total accepted
-        self.process_metric(json_data, 'ConnAccepted', 'counter')
-        self.process_metric(json_data, 'ConnCount', 'gauge')
-
-        # healthcheck metrics, both errors and connections
-        hc_tags = ['keyspace', 'shard', 'type']
-        self.process_metric(json_data, 'HealthcheckErrors', 'counter', parse_tags=hc_tags)
-        self.process_metric(json_data, 'HealthcheckConnections', 'gauge', parse_tags=hc_tags)
-
-        # GC Stats
-        memstats = json_data['memstats']
-        self.process_metric(memstats, 'GCCPUFraction', 'counter', prefix='GC.', alt_name='CPUFraction')
-        self.process_metric(memstats, 'PauseTotalNs', 'counter', prefix='GC.')
-
-        # We should endeavor to have 0 statements that are unfriendly to filtered replication for any keyspaces that want to be sharded
-        self.process_metric(json_data, 'FilteredReplicationUnfriendlyStatementsCount', 'counter')
-
-        self.process_rates(json_data, 'QPSByDbType', 'DbType')
-        self.process_rates(json_data, 'QPSByKeyspace', 'Keyspace')
-        self.process_rates(json_data, 'QPSByOperation', 'Operation')
-        self.process_rates(json_data, 'ErrorsByDbType', 'DbType')
-        self.process_rates(json_data, 'ErrorsByKeyspace', 'Keyspace')
-        self.process_rates(json_data, 'ErrorsByOperation', 'Operation')
-        self.process_rates(json_data, 'ErrorsByCode', 'Code')
-
-        # Subtracting VtgateApi from VttabletCall times below should allow seeing what overhead vtgate adds
-        parse_tags = ['Operation', 'Keyspace', 'DbType']
-        self.process_timing_data(json_data, 'VtgateApi', parse_tags=parse_tags)
-        parse_tags = ['Operation', 'Keyspace', 'DbType', 'Code']
-        self.process_metric(json_data, 'VtgateApiErrorCounts', 'counter', parse_tags=parse_tags)
-
-        parse_tags = ['Operation', 'Keyspace', 'ShardName', 'DbType']
-        self.process_metric(json_data, 'VttabletCallErrorCount', 'counter', parse_tags=parse_tags)
-        self.process_timing_data(json_data, 'VttabletCall', parse_tags=parse_tags)
-
-        parse_tags = ['Keyspace', 'ShardName']
-        self.process_metric(json_data, 'BufferUtilizationSum', 'counter', parse_tags=parse_tags)
-        self.process_metric(json_data, 'BufferStarts', 'counter', parse_tags=parse_tags)
-        self.process_metric(json_data, 'BufferRequestsBuffered', 'counter', parse_tags=parse_tags)
-        self.process_metric(json_data, 'BufferRequestsDrained', 'counter', parse_tags=parse_tags)
-
-        parse_tags = ['Keyspace', 'ShardName', 'Reason']
-        self.process_metric(json_data, 'BufferRequestsEvicted', 'counter', parse_tags=parse_tags)
-        self.process_metric(json_data, 'BufferRequestsSkipped', 'counter', parse_tags=parse_tags)
-
     def process_rates(self, json_data, metric_name, tag_name):
         rates = json_data[metric_name]
 
         for key, values in rates.items():
             if key.lower() == "all":
                 continue
+            if not values:
+                continue
+            # Vitess keeps one sample per minute, fewer than 15 right after it starts
             oneMin = values[-1]
-            fiveMin = sum(values[-5:])/5
-            fifteenMin = sum(values[-15:])/15
+            fiveMin = sum(values[-5:]) / len(values[-5:])
+            fifteenMin = sum(values[-15:]) / len(values[-15:])
 
             tags = dict()
             tags[tag_name] = key
+            if self.group_rates:
+                self.emitter.emit_multi("vitess.%s" % metric_name, [oneMin, fiveMin, fifteenMin], RATES_TYPE, tags)
+                continue
             self.emitter.emit("vitess.%s.1min" % metric_name, oneMin, 'gauge', tags)
             self.emitter.emit("vitess.%s.5min" % metric_name, fiveMin, 'gauge', tags)
             self.emitter.emit("vitess.%s.15min" % metric_name, fifteenMin, 'gauge', tags)
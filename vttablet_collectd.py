@@ -4,8 +4,114 @@ import time
 import util
 
 NAME = 'vttablet'
+CONNECTION_POOLS = ['Conn', 'AppConn', 'DbaConn', 'StreamConn', 'Transaction']
+ACL_TAGS = ['table', 'plan', 'id', 'user']
+
+def isMaster(val):
+    return 1 if val.lower() == 'master' else 0
+
+util.TRANSFORMERS['isMaster'] = isMaster
+
+# The metrics collected from /debug/vars, compiled into an extraction plan by util.BaseCollector.compile_plan
+METRICS = [
+    # Current connections and total accepted
+    {'name': 'ConnAccepted', 'type': 'counter'},
+    {'name': 'ConnCount', 'type': 'gauge'},
+
+    # Health-related metrics.
+    # TabletState is an integer mapping to one of SERVING (2), NOT_SERVING (0, 1, 3), or SHUTTING_DOWN (4)
+    {'name': 'TabletState', 'type': 'gauge'},
+    # Report on whether this is a master
+    {'name': 'TabletType', 'type': 'gauge', 'alt_name': 'IsMaster', 'transformer': 'isMaster'},
+    {'name': 'HealthcheckErrors', 'type': 'counter', 'tags': ['keyspace', 'shard', 'type']},
+
+    # GC Stats
+    {'name': 'GCCPUFraction', 'source': 'memstats', 'type': 'counter', 'prefix': 'GC.', 'alt_name': 'CPUFraction'},
+    {'name': 'PauseTotalNs', 'source': 'memstats', 'type': 'counter', 'prefix': 'GC.'},
+]
+
+# Tracking usage of the various connection pools
+for pool_name in CONNECTION_POOLS:
+    METRICS.extend([
+        {'name': '%sPoolAvailable' % pool_name, 'type': 'gauge'},
+        {'name': '%sPoolCapacity' % pool_name, 'type': 'gauge'},
+        {'name': '%sPoolWaitCount' % pool_name, 'type': 'counter'},
+        {'name': '%sPoolWaitTime' % pool_name, 'type': 'counter', 'transformer': 'nsToMs'},
+    ])
+
+METRICS.extend([
+    # If enabled, track histogram of number of results returned from user queries
+    {'kind': 'histogram', 'name': 'Results', 'flag': 'include_results_histogram'},
+
+    # Counters tagged by type, for tracking various error modes of the vttablet
+    {'name': 'Errors', 'type': 'counter', 'tags': ['type']},
+    {'name': 'InternalErrors', 'type': 'counter', 'tags': ['type']},
+    {'name': 'Kills', 'type': 'counter', 'tags': ['type']},
+
+    # Counters tagged by table and type, for tracking counts of the various query types, times, and ways in which a query can fail
+    # all broken down by table
+    {'name': 'QueryCounts', 'type': 'counter', 'tags': ['table', 'type']},
+    {'name': 'QueryErrorCounts', 'type': 'counter', 'tags': ['table', 'type']},
+    {'name': 'QueryRowCounts', 'type': 'counter', 'tags': ['table', 'type']},
+    {'name': 'QueryTimesNs', 'type': 'counter', 'tags': ['table', 'type'], 'transformer': 'nsToMs'},
+
+    # Tracks data from information_schema about the size of tables. These change slowly, so may be collected less
+    # often with GroupInterval "TableSizes"
+    {'name': 'DataFree', 'type': 'gauge', 'tags': ['table'], 'group': 'TableSizes'},
+    {'name': 'DataLength', 'type': 'gauge', 'tags': ['table'], 'group': 'TableSizes'},
+    {'name': 'IndexLength', 'type': 'gauge', 'tags': ['table'], 'group': 'TableSizes'},
+    {'name': 'TableRows', 'type': 'gauge', 'tags': ['table'], 'group': 'TableSizes'},
+
+    # Tracks counts and timings of user queries by user, table, and type
+    {'name': 'UserTableQueryCount', 'type': 'counter', 'tags': ['table', 'user', 'type'], 'tier': util.TIER_DETAIL},
+    {'name': 'UserTableQueryTimesNs', 'type': 'counter', 'alt_name': 'UserTableQueryTime', 'tags': ['table', 'user', 'type'], 'transformer': 'nsToMs', 'tier': util.TIER_DETAIL},
+
+    # Tracks counts and timings of user transactions by user and type
+    {'name': 'UserTransactionCount', 'type': 'counter', 'tags': ['user', 'type'], 'tier': util.TIER_DETAIL},
+    {'name': 'UserTransactionTimesNs', 'type': 'counter', 'alt_name': 'UserTransactionTime', 'tags': ['user', 'type'], 'transformer': 'nsToMs', 'tier': util.TIER_DETAIL},
+
+    # Tracks a variety of metrics for timing of the various layers of execution
+    # MySQL is how long it takes to actually execute in MySQL. While Queries is the total time with vitess overhead
+    # Waits tracks instances where we are able to consolidate identical queries while waiting for a connection
+    {'kind': 'timing', 'name': 'Mysql'},
+    {'kind': 'timing', 'name': 'Queries'},
+    {'kind': 'timing', 'name': 'Transactions'},
+    {'kind': 'timing', 'name': 'Waits'},
+    {'kind': 'timing', 'name': 'ExternalReparents', 'flag': 'include_reparent_timings'},
+
+    # MySQL timings above, broken down by user
+    {'kind': 'timing', 'name': 'MysqlAllPrivs', 'flag': 'include_per_user_timings'},
+    {'kind': 'timing', 'name': 'MysqlApp', 'flag': 'include_per_user_timings'},
+    {'kind': 'timing', 'name': 'MysqlDba', 'flag': 'include_per_user_timings'},
+
+    # Track usage of Vitess' query PLAN cache
+    {'name': 'QueryCacheCapacity', 'type': 'gauge', 'alt_name': 'QueryPlanCacheCapacity'},
+    {'name': 'QueryCacheLength', 'type': 'gauge', 'alt_name': 'QueryPlanCacheLength'},
+
+    # Tracks messages sent and success of delivery for the stream log
+    {'name': 'StreamlogSend', 'type': 'counter', 'tags': ['log'], 'flag': 'include_streamlog_stats'},
+    {'name': 'StreamlogDelivered', 'type': 'counter', 'tags': ['log', 'subscriber'], 'flag': 'include_streamlog_stats'},
+    {'name': 'StreamlogDeliveryDroppedMessages', 'type': 'counter', 'tags': ['log', 'subscriber'], 'flag': 'include_streamlog_stats'},
+
+    # Tracks the impact of ACLs on user queries
+    {'name': 'TableACLAllowed', 'type': 'counter', 'tags': ACL_TAGS, 'flag': 'include_acl_stats'},
+    {'name': 'TableACLDenied', 'type': 'counter', 'tags': ACL_TAGS, 'flag': 'include_acl_stats'},
+    {'name': 'TableACLPseudoDenied', 'type': 'counter', 'tags': ACL_TAGS, 'flag': 'include_acl_stats'},
+    # Super users are exempt and are tracked by this
+    {'name': 'TableACLExemptCount', 'type': 'counter', 'flag': 'include_acl_stats'},
+    # Look for DDL executed by users not in migration group
+    {'kind': 'custom', 'name': 'TableACLAllowed', 'method': 'process_unprivileged_ddl', 'flag': 'include_acl_stats'},
+
+    {'name': 'HeartbeatCumulativeLagNs', 'type': 'counter', 'flag': 'include_heartbeat'},
+    {'name': 'HeartbeatReads', 'type': 'counter', 'flag': 'include_heartbeat'},
+    {'name': 'HeartbeatReadErrors', 'type': 'counter', 'flag': 'include_heartbeat'},
+    {'name': 'HeartbeatWrites', 'type': 'counter', 'flag': 'include_heartbeat'},
+    {'name': 'HeartbeatWriteErrors', 'type': 'counter', 'flag': 'include_heartbeat'},
+])
 
 class Vttablet(util.BaseCollector):
+    metrics = METRICS
+
     def __init__(self, collectd, json_provider=None, verbose=False, interval=None):
         super(Vttablet, self).__init__(collectd, NAME, 15101, json_provider, verbose, interval)
         self.include_per_user_timings = True
@@ -33,111 +139,10 @@ class Vttablet(util.BaseCollector):
 
         self.register_read_callback()
 
-    def process_data(self, json_data):
-        # Current connections and total accepted
-        self.process_metric(json_data, 'ConnAccepted', 'counter')
-        self.process_metric(json_data, 'ConnCount', 'gauge')
-
-        # Health-related metrics.
-        # TabletState is an integer mapping to one of SERVING (2), NOT_SERVING (0, 1, 3), or SHUTTING_DOWN (4)
-        self.process_metric(json_data, 'TabletState', 'gauge')
-        # Report on whether this is a master
-        self.process_metric(json_data, 'TabletType', 'gauge', alt_name='IsMaster', transformer=lambda val: 1 if val.lower() == 'master' else 0)
-        self.process_metric(json_data, 'HealthcheckErrors', 'counter', parse_tags=['keyspace', 'shard', 'type'])
-
-        # GC Stats
-        memstats = json_data['memstats']
-        self.process_metric(memstats, 'GCCPUFraction', 'counter', prefix='GC.', alt_name='CPUFraction')
-        self.process_metric(memstats, 'PauseTotalNs', 'counter', prefix='GC.')
-
-        # Tracking usage of the various connection pools
-        self.process_pool_data(json_data, 'Conn')
-        self.process_pool_data(json_data, 'AppConn')
-        self.process_pool_data(json_data, 'DbaConn')
-        self.process_pool_data(json_data, 'StreamConn')
-        self.process_pool_data(json_data, 'Transaction')
-
-        # If enabled, track histogram of number of results returned from user queries
-        if self.include_results_histogram:
-            self.process_histogram(json_data, 'Results')
-
-        # Counters tagged by type, for tracking various error modes of the vttablet
-        for metric in ['Errors', 'InternalErrors', 'Kills']:
-            self.process_metric(json_data, metric, 'counter', parse_tags=['type'])
-
-        # Counters tagged by table and type, for tracking counts of the various query types, times, and ways in which a query can fail
-        # all broken down by table
-        for metric in ['QueryCounts', 'QueryErrorCounts', 'QueryRowCounts', 'QueryTimesNs']:
-            alt_name = 'QueryTimes' if metric == 'QueryTimeNs' else None
-            transformer = util.nsToMs if metric == 'QueryTimesNs' else None
-            self.process_metric(json_data, metric, 'counter', alt_name=alt_name, parse_tags=['table', 'type'], transformer=transformer)
-
-        # Tracks data from information_schema about the size of tables
-        for metric in ['DataFree', 'DataLength', 'IndexLength', 'TableRows']:
-            self.process_metric(json_data, metric, 'gauge', parse_tags=['table'])
-
-        # Tracks counts and timings of user queries by user, table, and type
-        user_table_tags = ['table', 'user', 'type']
-        self.process_metric(json_data, 'UserTableQueryCount', 'counter', parse_tags=user_table_tags)
-        self.process_metric(json_data, 'UserTableQueryTimesNs', 'counter', alt_name='UserTableQueryTime', parse_tags=user_table_tags, transformer=util.nsToMs)
-
-        # Tracks counts and timings of user transactions by user and type
-        user_tx_tags = ['user', 'type']
-        self.process_metric(json_data, 'UserTransactionCount', 'counter', parse_tags=user_tx_tags)
-        self.process_metric(json_data, 'UserTransactionTimesNs', 'counter', alt_name='UserTransactionTime', parse_tags=user_tx_tags, transformer=util.nsToMs)
-
-        # Tracks a variety of metrics for timing of the various layers of execution
-        # MySQL is how long it takes to actually execute in MySQL. While Queries is the total time with vitess overhead
-        # Waits tracks instances where we are able to consolidate identical queries while waiting for a connection
-        self.process_timing_data(json_data, 'Mysql')
-        self.process_timing_data(json_data, 'Queries')
-        self.process_timing_data(json_data, 'Transactions')
-        self.process_timing_data(json_data, 'Waits')
-        if self.include_reparent_timings:
-            self.process_timing_data(json_data, 'ExternalReparents')
-
-        # MySQL timings above, broken down by user
-        if self.include_per_user_timings:
-            self.process_timing_data(json_data, 'MysqlAllPrivs')
-            self.process_timing_data(json_data, 'MysqlApp')
-            self.process_timing_data(json_data, 'MysqlDba')
-
-        # Track usage of Vitess' query PLAN cache
-        self.process_metric(json_data, 'QueryCacheCapacity', 'gauge', alt_name='QueryPlanCacheCapacity')
-        self.process_metric(json_data, 'QueryCacheLength', 'gauge', alt_name='QueryPlanCacheLength')
-
-        # Tracks messages sent and success of delivery for the stream log
-        if self.include_streamlog_stats:
-            self.process_metric(json_data, 'StreamlogSend', 'counter', parse_tags=['log'])
-            parse_tags = ['log', 'subscriber']
-            self.process_metric(json_data, 'StreamlogDelivered', 'counter', parse_tags=parse_tags)
-            self.process_metric(json_data, 'StreamlogDeliveryDroppedMessages', 'counter', parse_tags=parse_tags)
-
-        # Tracks the impact of ACLs on user queries
-        if self.include_acl_stats:
-            acl_tags = ['table', 'plan', 'id', 'user']
-            self.process_metric(json_data, 'TableACLAllowed', 'counter', parse_tags=acl_tags)
-            self.process_metric(json_data, 'TableACLDenied', 'counter', parse_tags=acl_tags)
-            self.process_metric(json_data, 'TableACLPseudoDenied', 'counter', parse_tags=acl_tags)
-            # Super users are exempt and are tracked by this
-            self.process_metric(json_data, 'TableACLExemptCount', 'counter')
-            # Look for DDL executed by users not in migration group
-            for tags, value in self._extract_values(json_data, 'TableACLAllowed', acl_tags):
-                if tags['id'] == "DDL" and not tags['user'].startswith('migration.'):
-                    self.emitter.emit("UnprivilegedDDL", value, 'counter', tags)
-
-        if self.include_heartbeat:
-            self.process_metric(json_data, 'HeartbeatCumulativeLagNs', 'counter')
-            self.process_metric(json_data, 'HeartbeatReads', 'counter')
-            self.process_metric(json_data, 'HeartbeatReadErrors', 'counter')
-            self.process_metric(json_data, 'HeartbeatWrites', 'counter')
-            self.process_metric(json_data, 'HeartbeatWriteErrors', 'counter')
-
-    def process_pool_data(self, json_data, pool_name):
-        self.process_metric(json_data, '%sPoolAvailable' % pool_name, 'gauge')
-        self.process_metric(json_data, '%sPoolCapacity' % pool_name, 'gauge')
-        self.process_metric(json_data, '%sPoolWaitCount' % pool_name, 'counter')
-        self.process_metric(json_data, '%sPoolWaitTime' % pool_name, 'counter', transformer=util.nsToMs)
+    def process_unprivileged_ddl(self, json_data, metric_name):
+        for tags, value in self._extract_values(json_data, metric_name, ACL_TAGS):
+            if tags['id'] == "DDL" and not tags['user'].startswith('migration.'):
+                self.emitter.emit("UnprivilegedDDL", value, 'counter', tags)
 
 if __name__ == '__main__':
     util.run_local(NAME, Vttablet)